@@ -1,3 +1,4 @@
+import collections
 import datetime
 import functools
 import os
@@ -7,6 +8,7 @@ import appdaemon.plugins.hass.hassapi as hass
 import voluptuous as vol
 
 import conditions
+import logger
 
 CONF_TRIGGER_ACTIVATE_CONDITION = 'trigger_activate_condition'
 CONF_TRIGGER_DEACTIVATE_CONDITION = 'trigger_deactivate_condition'
@@ -33,6 +35,7 @@ DEFAULT_GRACE_PERIOD_TIMEOUT = 10
 DEFAULT_ON_STATE = 'on'
 DEFAULT_STATE_UPDATE_TIMEOUT=3
 DEFAULT_MAX_ACTIONS_PER_MIN=4
+DEFAULT_ACTION_HISTORY_SECONDS=60
 
 KEY_FRIENDLY_NAME = 'friendly_name'
 KEY_ACTIVATE = 'activate'
@@ -111,6 +114,10 @@ CONFIG_SCHEMA = vol.Schema({
   vol.Optional(CONF_MAX_ACTIONS_PER_MIN,
                default=DEFAULT_MAX_ACTIONS_PER_MIN): vol.Range(min=0),
 
+  vol.Optional(logger.CONF_VERBOSITY,
+               default=logger.DEFAULT_VERBOSITY):
+      logger.CONFIG_VERBOSITY_SCHEMA,
+
   vol.Required(CONF_OUTPUT): OUTPUT_SCHEMA,
 }, extra=vol.ALLOW_EXTRA)
 
@@ -121,8 +128,10 @@ def timedelta_to_str(td):
 
 @functools.total_ordering
 class Timer(object):
-  def __init__(self, app, func=None, seconds=None, name='timer', kwargs=None):
+  def __init__(self, app, func=None, seconds=None, name='timer', kwargs=None,
+               log=None):
     self._app = app
+    self._log = log or logger.Logger(app)
     self._func = func
     self._seconds = seconds
     self._name = name
@@ -144,12 +153,12 @@ class Timer(object):
     self._handle = self._app.run_in(
         lambda kwargs: self._log_wrap(self._func, self._kwargs),
         seconds)
-    self._app.log('Created timer: (%s, %s) for %i seconds' % (
-        self._name, self._handle, seconds))
+    self._log.debug('Created timer: (%s, %s) for %i seconds',
+        self._name, self._handle, seconds)
 
   def cancel(self):
     if self._handle:
-      self._app.log('Cancel timer: (%s, %s)' % (self._name, self._handle))
+      self._log.debug('Cancel timer: (%s, %s)', self._name, self._handle)
       self._app.cancel_timer(self._handle)
       self._raw_reset()
 
@@ -187,13 +196,47 @@ class Timer(object):
     return '<Timer:%s,%s,%s>' % (self._name,
         self.get_time_until_expire_string(), self._handle)
 
+class ActionHistory(object):
+  """The actions taken within the last window seconds, as (datetime,
+  activate, output_id), oldest first. The most recent action is retained
+  regardless of age.
+
+  The number of distinct consecutive actions (e.g. on->off->on == 3) is
+  maintained as actions are added and expire."""
+  def __init__(self, window=DEFAULT_ACTION_HISTORY_SECONDS):
+    self._window = datetime.timedelta(seconds=window)
+    self._actions = collections.deque()
+    # The number of adjacent pairs of actions that differ in activate.
+    self._transitions = 0
+
+  def add(self, dt, activate, output_id):
+    if self._actions and self._actions[-1][1] != activate:
+      self._transitions += 1
+    self._actions.append((dt, activate, output_id))
+
+  def expire(self, now):
+    while (len(self._actions) > 1 and
+           now - self._actions[0][0] >= self._window):
+      _, activate, _ = self._actions.popleft()
+      if self._actions[0][1] != activate:
+        self._transitions -= 1
+
+  def get_last(self):
+    return self._actions[-1] if self._actions else None
+
+  def get_distinct_count(self):
+    return self._transitions + 1 if self._actions else 0
+
+  def __repr__(self):
+    return '<ActionHistory:%s>' % list(self._actions)
+
 # A note on state: As much as possible, attempt to store the authoritative
 # state in HA (retrieved via Appdaemon get_state(), not here.
 
 class AutoLights(hass.Hass):
   def initialize(self):
     self._manual_mode = False
-    self._last_actions = []
+    self._last_actions = ActionHistory()
     self._last_trigger = {
         KEY_ACTIVATE: None,
         KEY_DEACTIVATE: None
@@ -201,11 +244,35 @@ class AutoLights(hass.Hass):
 
     self._config = CONFIG_SCHEMA(self.args)
     self._status_var = self._config.get(CONF_STATUS_VAR)
-
-    self._main_timer = Timer(self, self._main_timer_expire, name='main')
-    self._pause_timer = Timer(self, self._pause_timer_expire, name='pause')
+    self._logger = logger.Logger(self, self._config.get(logger.CONF_VERBOSITY))
+
+    self._compiled_conditions = {
+        conf_condition: conditions.compile_condition(
+            self._config.get(conf_condition), reorder=True)
+        for conf_condition in (
+            CONF_TRIGGER_ACTIVATE_CONDITION,
+            CONF_TRIGGER_DEACTIVATE_CONDITION)}
+
+    # Extend/disable conditions are read on every callback and status update,
+    # so their values are maintained incrementally from state changes (and
+    # time boundaries) instead.
+    self._incremental_conditions = {
+        conf_condition: conditions.IncrementalCondition(
+            self, self._config.get(conf_condition))
+        for conf_condition in (
+            CONF_EXTEND_CONDITION,
+            CONF_DISABLE_CONDITION)}
+    self._compiled_output_conditions = conditions.compile_many(
+        [output.get(CONF_CONDITION) for output in self._config.get(CONF_OUTPUT)],
+        reorder=True)
+
+    self._main_timer = Timer(self, self._main_timer_expire, name='main',
+        log=self._logger)
+    self._pause_timer = Timer(self, self._pause_timer_expire, name='pause',
+        log=self._logger)
     self._state_update_timer = Timer(self,
-        seconds=DEFAULT_STATE_UPDATE_TIMEOUT, name='state_update')
+        seconds=DEFAULT_STATE_UPDATE_TIMEOUT, name='state_update',
+        log=self._logger)
 
     self._listen_condition('activate', CONF_TRIGGER_ACTIVATE_CONDITION,
         self._trigger_callback, activate=True)
@@ -242,7 +309,7 @@ class AutoLights(hass.Hass):
     return self._listen_entities(name, entities, func, **kwargs)
 
   def _listen_entities(self, name, entities, func, **kwargs):
-    self.log('Listening to %s entities -> %s' % (name, entities))
+    self._logger.info('Listening to %s entities -> %s', name, entities)
 
     for entity_id in entities:
       self.listen_state(func, entity_id, **kwargs)
@@ -259,13 +326,12 @@ class AutoLights(hass.Hass):
         state_entities.append(deactivate_entity)
     return state_entities
 
-  def _get_best_matching_output(self, triggers=None):
-    for output in self._config.get(CONF_OUTPUT):
-      if conditions.evaluate_condition(
-          self, self.datetime(), output.get(CONF_CONDITION),
-          triggers=triggers):
-        return output
-    return None
+  def _get_best_matching_output_id(self, triggers=None, snapshot=None):
+    """Return the index of the first matching output, or None."""
+    return conditions.evaluate_many(
+        self._compiled_output_conditions,
+        snapshot or conditions.StateSnapshot(self),
+        first_match=True, triggers=triggers)
 
   def _update_status(self, kwargs=None):
     if self._status_var:
@@ -307,32 +373,38 @@ class AutoLights(hass.Hass):
 
   def _should_extend(self):
     return (self._config.get(CONF_EXTEND_CONDITION) and
-        conditions.evaluate_condition(
-            self, self.datetime(), self._config.get(CONF_EXTEND_CONDITION)))
+        self._incremental_conditions[CONF_EXTEND_CONDITION].value)
 
   def _is_disabled(self):
     return (self._config.get(CONF_DISABLE_CONDITION) and
-        conditions.evaluate_condition(
-            self, self.datetime(), self._config.get(CONF_DISABLE_CONDITION)))
+        self._incremental_conditions[CONF_DISABLE_CONDITION].value)
+
+  def _update_incremental_conditions(self, entity, new):
+    # The extend/disable callbacks for an entity may run after other
+    # callbacks for the same state change, so bring the values up to date
+    # before they are read.
+    for incremental_condition in self._incremental_conditions.values():
+      incremental_condition.update(entity, new)
 
   def _main_timer_expire(self, kwargs):
-    self.log('Main timer expired at %s' % self.datetime())
+    self._logger.info('Main timer expired at %s', self.datetime())
 
     if self._should_extend():
-      self.log('Extending main timer ...')
+      self._logger.info('Extending main timer ...')
       self._main_timer.create(self._get_soft_timeout())
       return
 
-    output = self._get_best_matching_output()
-    if output:
-      self._deactivate(output)
+    output_id = self._get_best_matching_output_id()
+    if output_id is not None:
+      self._deactivate(output_id)
 
-  def _deactivate(self, output):
-    return self._activate(output, activate=False)
+  def _deactivate(self, output_id):
+    return self._activate(output_id, activate=False)
 
-  def _activate(self, output, activate=True):
-    self.log('%s output: %s' % (
-        'Activating' if activate else 'Deactivating', output))
+  def _activate(self, output_id, activate=True):
+    output = self._config.get(CONF_OUTPUT)[output_id]
+    self._logger.debug('%s output: %s',
+        'Activating' if activate else 'Deactivating', output)
 
     override_service = None
     override_data = None
@@ -363,43 +435,23 @@ class AutoLights(hass.Hass):
       else:
         self.turn_off(entity[CONF_ENTITY_ID], **data)
 
-    self._last_actions.insert(0, (self.datetime(), activate, output))
-
-  def _prune_last_actions(self):
-    # Retain every action from the last minute, or minimum of 1 action
-    # (regardless of time).
-    out_last_actions = []
-
-    for tpl in self._last_actions:
-      if self._seconds_since_dt(tpl[0]) < 60:
-        out_last_actions.append(tpl)
-    if not out_last_actions and self._last_actions:
-      out_last_actions.append(self._last_actions[0])
-    self._last_actions = out_last_actions
-
-  def _opposing_last_actions(self):
-    """Return how many distinct last actions (e.g. on->off->on == 3)."""
-    last_activate = None
-    distinct = 0
-    for (dt, activate, output) in self._last_actions:
-      if last_activate is None:
-        distinct = 1
-      elif last_activate != activate:
-        distinct += 1
-      last_activate = activate
-    return distinct
-
-  def _has_on_state_entity(self):
+    self._last_actions.add(self.datetime(), activate, output_id)
+
+  def _has_on_state_entity(self, snapshot=None):
     for entity in self._state_entities:
-      if self.get_state(entity[CONF_ENTITY_ID]) == entity[CONF_ON_STATE]:
+      if ((snapshot or self).get_state(entity[CONF_ENTITY_ID]) ==
+          entity[CONF_ON_STATE]):
         return True
     return False
 
   def _state_callback(self, entity, attribute, old, new, kwargs):
-    self.log('State callback: %s (old: %s, new: %s)' % (entity, old, new))
+    self._logger.debug(
+        'State callback: %s (old: %s, new: %s)', entity, old, new)
+    snapshot = conditions.StateSnapshot(self)
+    self._update_incremental_conditions(entity, new)
 
     if self._is_disabled():
-      self.log('Disabled: Ignoring state for: %s' % entity)
+      self._logger.debug('Disabled: Ignoring state for: %s', entity)
       return
 
     # A note on manual mode: Manual mode is not enabled when any
@@ -408,14 +460,15 @@ class AutoLights(hass.Hass):
     # impact that lighting do not constitute conversion to manual mode (e.g.
     # status controller events).  Automations that work outside of automated
     # lighting times will indeed convert this to manual mode.
-    if self._has_on_state_entity():
+    if self._has_on_state_entity(snapshot):
       if not self._state_update_timer and not self._main_timer:
         # If there's a light on, but there was not a change made by this app,
         # change to manual mode. We cannot use the expiry timers here, as there
         # may be a time delay between those timers expiring and the new state
         # arriving here (which is exactly what the state timer is designed to
         # work around).
-        self.log('Changed to manual mode: %s (%s->%s)' % (entity, old, new))
+        self._logger.info(
+            'Changed to manual mode: %s (%s->%s)', entity, old, new)
         self._manual_mode = True
 
         # A changing state entity resets the timer.
@@ -442,8 +495,9 @@ class AutoLights(hass.Hass):
     # pause triggers for <grace_period>.
     if (not self._state_update_timer and
         self._config.get(CONF_GRACE_PERIOD_TIMEOUT) > 0):
-      self.log('Pausing due externally applied state change: %s (%s->%s)' % (
-          entity, old, new))
+      self._logger.info(
+          'Pausing due externally applied state change: %s (%s->%s)',
+          entity, old, new)
       self._pause_timer.create(
           seconds=self._config.get(CONF_GRACE_PERIOD_TIMEOUT))
 
@@ -457,38 +511,49 @@ class AutoLights(hass.Hass):
 
   def _trigger_callback(self, entity, attribute, old, new, kwargs):
     activate = kwargs[KEY_ACTIVATE]
-    self.log('Trigger callback (activate=%s): %s (old: %s, new: %s)' % (
-        activate, entity, old, new))
+    self._logger.debug(
+        'Trigger callback (activate=%s): %s (old: %s, new: %s)',
+        activate, entity, old, new)
 
     if old == 'unavailable':
-      self.log('Unavailable: Skipping previously unavailable state for: %s' % entity)
+      self._logger.debug(
+          'Unavailable: Skipping previously unavailable state for: %s', entity)
       return
 
+    self._update_incremental_conditions(entity, new)
     if self._is_disabled():
-      self.log('Disabled: Skipping trigger for: %s' % entity)
+      self._logger.debug('Disabled: Skipping trigger for: %s', entity)
       return
     elif self._pause_timer:
-      self.log('Paused: Skipping trigger for: %s' % entity)
+      self._logger.debug('Paused: Skipping trigger for: %s', entity)
       return
     elif self._manual_mode:
-      self.log('Manual mode: Skipping trigger for: %s' % entity)
+      self._logger.debug('Manual mode: Skipping trigger for: %s', entity)
       return
 
+    # Entity states are shared by all condition evaluations up until this
+    # callback takes any action.
+    snapshot = conditions.StateSnapshot(self)
+
     triggers={entity: new}
-    condition = self._config.get(
+    condition = self._compiled_conditions[
         CONF_TRIGGER_ACTIVATE_CONDITION if activate
-        else CONF_TRIGGER_DEACTIVATE_CONDITION)
-    triggered = conditions.evaluate_condition(self, self.datetime(),
-        condition, triggers=triggers)
+        else CONF_TRIGGER_DEACTIVATE_CONDITION]
+    triggered = condition(self, self.datetime(), triggers=triggers,
+                          snapshot=snapshot)
 
     activate_key = KEY_ACTIVATE if activate else KEY_DEACTIVATE
 
     if triggered:
-      output = self._get_best_matching_output(triggers=triggers)
-      if output:
-        # Prune last actions list.
-        self._prune_last_actions()
-        self.log('Last-actions: %s' % self._last_actions)
+      output_id = self._get_best_matching_output_id(
+          triggers=triggers, snapshot=snapshot)
+      if output_id is not None:
+        output = self._config.get(CONF_OUTPUT)[output_id]
+
+        # Retain every action from the last minute, or minimum of 1 action
+        # (regardless of time).
+        self._last_actions.expire(self.datetime())
+        self._logger.debug('Last-actions: %s', self._last_actions)
 
         # Safety precaution: Pause changes if more distinct actions than
         # max_actions_per_min (avoid lights flapping due to more configuration
@@ -500,13 +565,14 @@ class AutoLights(hass.Hass):
         # walking past multiple motion sensors is just fine).
         max_actions_per_min = self._config.get(CONF_MAX_ACTIONS_PER_MIN)
 
-        if self._opposing_last_actions() >= max_actions_per_min:
-          self.log('Pausing attempts to %s output as >%i (%s) distinct '
-                   'actions have been executed in the last minute: %s' % (
+        if self._last_actions.get_distinct_count() >= max_actions_per_min:
+          self._logger.info(
+              'Pausing attempts to %s output as >%i (%s) distinct '
+              'actions have been executed in the last minute: %s',
               activate_key,
               max_actions_per_min,
               CONF_MAX_ACTIONS_PER_MIN,
-              output))
+              output)
           # Pause for 1 minute (it's max actions per minute).
           self._pause_timer.create(seconds=1*60)
           self._update_status()
@@ -515,18 +581,19 @@ class AutoLights(hass.Hass):
         # If this would just activate the exact same output, just reset
         # the timer rather than re-activating (as otherwise we lose custom
         # adjustments made to the lighting).
-        if (activate and self._main_timer and self._last_actions and
-            self._last_actions[0][1] == activate and
-            self._last_actions[0][2] == output):
-          self.log('Same output triggered by %s. '
-                   'Resetting timer only.' % entity)
+        last_action = self._last_actions.get_last()
+        if (activate and self._main_timer and last_action and
+            last_action[1] == activate and
+            last_action[2] == output_id):
+          self._logger.debug('Same output triggered by %s. '
+                             'Resetting timer only.', entity)
           self._main_timer.create(self._get_soft_timeout())
         else:
           if activate:
             self._main_timer.create(self._get_soft_timeout())
           else:
             self._main_timer.cancel()
-          self._activate(output, activate=activate)
+          self._activate(output_id, activate=activate)
 
         self._last_trigger[activate_key] = self.get_state(
             entity, attribute=KEY_FRIENDLY_NAME)
@@ -537,14 +604,16 @@ class AutoLights(hass.Hass):
     self._update_status()
 
   def _extend_callback(self, entity, attribute, old, new, kwargs):
+    self._incremental_conditions[CONF_EXTEND_CONDITION].update(entity, new)
     self._update_status()
 
   def _disable_callback(self, entity, attribute, old, new, kwargs):
+    self._incremental_conditions[CONF_DISABLE_CONDITION].update(entity, new)
     if self._is_disabled():
-      self.log('Disabled: Triggered by %s (%s->%s)' % (entity, old, new))
+      self._logger.info('Disabled: Triggered by %s (%s->%s)', entity, old, new)
       self._main_timer.cancel()
     else:
-      self.log('Enabled: Triggered by %s (%s->%s)' % (entity, old, new))
+      self._logger.info('Enabled: Triggered by %s (%s->%s)', entity, old, new)
       if self._has_on_state_entity() and not self._main_timer:
         self._main_timer.create(self._get_soft_timeout())
       self._manual_mode = False
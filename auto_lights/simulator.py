@@ -0,0 +1,431 @@
+"""Deterministic simulation harness for auto_lights.py.
+
+Instantiates AutoLights against a fake hassapi (installed in sys.modules in
+place of AppDaemon's), with a virtual clock and scheduler (run_in, run_every,
+run_at, cancel_timer). A stream of state changes, (timestamp, entity_id, old,
+new), is replayed as fast as the callbacks run, and the simulator reports:
+
+  - per-callback latency (e.g. _state_callback, _trigger_callback, timers).
+  - service calls (turn_on/turn_off/call_service) and set_state calls.
+  - timer churn: timers created, cancelled and fired, and the peak number of
+    timers pending at once.
+
+Services take effect (as a state change of the target entity) after a fixed
+virtual delay, as HA would report them. No AppDaemon is required. Run
+directly, e.g.:
+
+  python simulator.py --days 7
+  python simulator.py --config apps.yaml --app living_room --stream history.csv
+
+Streams are CSV files with a header of timestamp,entity_id,old,new (ISO 8601
+timestamps, an empty old meaning the simulator's current state). Without a
+stream, a week of motion is generated for the trigger entities of the app.
+"""
+
+import argparse
+import csv
+import datetime
+import heapq
+import importlib
+import itertools
+import os
+import random
+import sys
+import time
+import traceback
+import types
+
+if __name__ == '__main__':
+  # When run directly (rather than by AppDaemon, which puts every app
+  # directory on the path), find the shared modules in common/.
+  sys.path.insert(0, os.path.join(
+      os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+
+import conditions
+
+HASSAPI_MODULE = 'appdaemon.plugins.hass.hassapi'
+
+DEFAULT_START = datetime.datetime(2020, 1, 6)
+DEFAULT_SERVICE_DELAY = 0.5
+DEFAULT_SUNRISE = datetime.time(6, 30)
+DEFAULT_SUNSET = datetime.time(18, 45)
+
+DEFAULT_CONFIG = {
+  'status_var': 'sensor.auto_lights_status',
+  'trigger_activate_condition': [{'binary_sensor.motion': 'on'}],
+  'output': [{
+    'activate_entities': [{'entity_id': 'light.room'}],
+  }],
+}
+
+
+class Stats(object):
+  def __init__(self):
+    self.latencies = {}
+    self.service_calls = {}
+    self.set_state_calls = 0
+    self.timers_created = 0
+    self.timers_cancelled = 0
+    self.timers_fired = 0
+    self.peak_timers = 0
+    self.errors = []
+
+  def add_latency(self, name, seconds):
+    self.latencies.setdefault(name, []).append(seconds)
+
+  def add_service_call(self, service):
+    self.service_calls[service] = self.service_calls.get(service, 0) + 1
+
+  def report(self, elapsed, simulated):
+    print('simulated %s in %.2fs (%.0fx real time)' % (
+        simulated, elapsed,
+        simulated.total_seconds() / elapsed if elapsed else 0))
+
+    print('callbacks:')
+    for name in sorted(self.latencies):
+      latencies = sorted(self.latencies[name])
+      print('  %-44s %8i calls  mean %8.1f us  p99 %8.1f us  '
+            'max %8.1f us' % (
+          name, len(latencies),
+          sum(latencies) / len(latencies) * 1e6,
+          latencies[int(len(latencies) * 0.99)] * 1e6,
+          latencies[-1] * 1e6))
+
+    print('service calls:')
+    for service in sorted(self.service_calls):
+      print('  %-44s %8i' % (service, self.service_calls[service]))
+    print('  %-44s %8i' % ('set_state', self.set_state_calls))
+
+    print('timers: created %i  cancelled %i  fired %i  peak pending %i' % (
+        self.timers_created, self.timers_cancelled, self.timers_fired,
+        self.peak_timers))
+
+    if self.errors:
+      print('errors: %i, the first being:' % len(self.errors))
+      print(self.errors[0])
+
+
+class Simulator(object):
+  """The virtual clock, scheduler and HA state shared by simulated apps."""
+  def __init__(self, start=DEFAULT_START,
+               service_delay=DEFAULT_SERVICE_DELAY, trace=False):
+    self.now = start
+    self.stats = Stats()
+    self._service_delay = datetime.timedelta(seconds=service_delay)
+    self._trace = trace
+
+    # Heap of (datetime, sequence, handle), with the pending timers (by
+    # handle) as handle -> (callback, kwargs, interval, internal). Cancelled
+    # timers are removed from _timers only, and skipped when popped.
+    self._heap = []
+    self._timers = {}
+    self._sequence = itertools.count()
+    self._handles = itertools.count(1)
+
+    # entity_id -> {'state': ..., 'attributes': {...}}
+    self._states = {}
+    # entity_id -> [(callback, kwargs), ...]
+    self._listeners = {}
+
+  # Scheduler.
+
+  def schedule(self, callback, when, interval=None, kwargs=None,
+               internal=False):
+    handle = next(self._handles)
+    self._timers[handle] = (callback, kwargs or {}, interval, internal)
+    heapq.heappush(self._heap, (when, next(self._sequence), handle))
+    if not internal:
+      self.stats.timers_created += 1
+      self.stats.peak_timers = max(
+          self.stats.peak_timers, self._count_timers())
+    return handle
+
+  def cancel(self, handle):
+    entry = self._timers.pop(handle, None)
+    if entry is not None and not entry[3]:
+      self.stats.timers_cancelled += 1
+
+  def _count_timers(self):
+    return sum(1 for entry in self._timers.values() if not entry[3])
+
+  def advance(self, until):
+    """Run every timer due up to until, moving the clock along with them."""
+    while self._heap and self._heap[0][0] <= until:
+      when, _, handle = heapq.heappop(self._heap)
+      entry = self._timers.get(handle)
+      if entry is None:
+        continue
+      callback, kwargs, interval, internal = entry
+      self.now = max(self.now, when)
+      if interval:
+        heapq.heappush(
+            self._heap, (when + interval, next(self._sequence), handle))
+      else:
+        del self._timers[handle]
+
+      if internal:
+        callback(**kwargs)
+      else:
+        self.stats.timers_fired += 1
+        self.call('timer:%s' % callback.__qualname__, callback, kwargs)
+    self.now = max(self.now, until)
+
+  def call(self, name, callback, *args):
+    start = time.perf_counter()
+    try:
+      callback(*args)
+    except Exception:
+      # As AppDaemon, log the exception and carry on.
+      self.stats.errors.append(traceback.format_exc())
+    finally:
+      self.stats.add_latency(name, time.perf_counter() - start)
+
+  # State.
+
+  def get_state(self, entity_id):
+    return self._states.get(entity_id)
+
+  def get_states(self):
+    return self._states
+
+  def set_state(self, entity_id, state, attributes=None):
+    """Set the state of entity_id, calling listeners if it changed."""
+    old = self._states.get(entity_id)
+    old_state = old['state'] if old else None
+    self._states[entity_id] = {
+      'entity_id': entity_id,
+      'state': state,
+      'attributes': dict(
+          (old or {}).get('attributes', {}), **(attributes or {})),
+      'last_changed': self.now.isoformat(),
+    }
+    if old_state != state:
+      for callback, kwargs in list(self._listeners.get(entity_id, [])):
+        self.call(callback.__name__, callback,
+                  entity_id, 'state', old_state, state, kwargs)
+
+  def listen_state(self, callback, entity_id, kwargs):
+    self._listeners.setdefault(entity_id, []).append((callback, kwargs))
+
+  def call_service(self, service, entity_id=None, **kwargs):
+    self.stats.add_service_call(service)
+    if self._trace:
+      print('%s %s %s %s' % (self.now, service, entity_id, kwargs))
+
+    state = {'turn_on': 'on', 'turn_off': 'off'}.get(service.split('/')[-1])
+    if state is None or entity_id is None:
+      return
+    entity_ids = [entity_id] if isinstance(entity_id, str) else entity_id
+    for target in entity_ids:
+      self.schedule(self.set_state, self.now + self._service_delay,
+                    kwargs={'entity_id': target, 'state': state},
+                    internal=True)
+
+  # Replay.
+
+  def replay(self, stream):
+    for timestamp, entity_id, old, new in stream:
+      self.advance(timestamp)
+      if old is not None and entity_id not in self._states:
+        self._states[entity_id] = {'state': old, 'attributes': {}}
+      self.set_state(entity_id, new)
+
+
+class Hass(object):
+  """Stands in for appdaemon.plugins.hass.hassapi.Hass, against a
+  Simulator."""
+  def __init__(self, simulator, name, args):
+    self._simulator = simulator
+    self.name = name
+    self.args = args
+
+  def datetime(self):
+    return self._simulator.now
+
+  def log(self, message, level='INFO', **kwargs):
+    if level in ('WARNING', 'ERROR'):
+      print('%s %s: %s' % (self._simulator.now, level, message))
+
+  def error(self, message, **kwargs):
+    self.log(message, level='ERROR')
+
+  def get_state(self, entity_id=None, attribute=None, default=None,
+                **kwargs):
+    if entity_id is None:
+      return dict(self._simulator.get_states())
+    if '.' not in entity_id:
+      return {key: value for key, value in
+              self._simulator.get_states().items()
+              if key.split('.', 1)[0] == entity_id}
+    state = self._simulator.get_state(entity_id)
+    if state is None:
+      return default
+    if attribute == 'all':
+      return state
+    if attribute is not None:
+      return state['attributes'].get(attribute, default)
+    return state['state']
+
+  def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+    self._simulator.stats.set_state_calls += 1
+    self._simulator.set_state(entity_id, state, attributes)
+
+  def listen_state(self, callback, entity_id, **kwargs):
+    self._simulator.listen_state(callback, entity_id, kwargs)
+
+  def turn_on(self, entity_id, **kwargs):
+    self.call_service('homeassistant/turn_on', entity_id=entity_id, **kwargs)
+
+  def turn_off(self, entity_id, **kwargs):
+    self.call_service('homeassistant/turn_off', entity_id=entity_id, **kwargs)
+
+  def call_service(self, service, **kwargs):
+    self._simulator.call_service(service, **kwargs)
+
+  def run_in(self, callback, seconds, **kwargs):
+    return self._simulator.schedule(
+        callback,
+        self._simulator.now + datetime.timedelta(seconds=seconds),
+        kwargs=kwargs)
+
+  def run_at(self, callback, start, **kwargs):
+    return self._simulator.schedule(callback, start, kwargs=kwargs)
+
+  def run_every(self, callback, start, interval, **kwargs):
+    if start == 'now':
+      start = self._simulator.now
+    return self._simulator.schedule(
+        callback, start, interval=datetime.timedelta(seconds=interval),
+        kwargs=kwargs)
+
+  def cancel_timer(self, handle):
+    self._simulator.cancel(handle)
+
+  def sunrise(self):
+    return self._next(DEFAULT_SUNRISE)
+
+  def sunset(self):
+    return self._next(DEFAULT_SUNSET)
+
+  def _next(self, value):
+    now = self._simulator.now
+    candidate = datetime.datetime.combine(now.date(), value)
+    if candidate <= now:
+      candidate += datetime.timedelta(days=1)
+    return candidate
+
+  def parse_datetime(self, value):
+    value = value.strip()
+    for event, method in (('sunrise', self.sunrise), ('sunset', self.sunset)):
+      if value.startswith(event):
+        offset = value[len(event):].replace(' ', '')
+        result = method()
+        if offset:
+          hours, minutes, *seconds = [int(x) for x in offset[1:].split(':')]
+          delta = datetime.timedelta(
+              hours=hours, minutes=minutes, seconds=sum(seconds))
+          result = result + delta if offset[0] == '+' else result - delta
+        return result
+    return datetime.datetime.combine(
+        self._simulator.now.date(),
+        datetime.datetime.strptime(value, '%H:%M:%S').time())
+
+
+def install_hassapi():
+  """Install a fake hassapi module (in place of AppDaemon's) so that apps can
+  be imported."""
+  module = types.ModuleType(HASSAPI_MODULE)
+  module.Hass = Hass
+  parent = None
+  for name in ('appdaemon', 'appdaemon.plugins', 'appdaemon.plugins.hass',
+               HASSAPI_MODULE):
+    sys.modules.setdefault(name, types.ModuleType(name))
+    if parent is not None:
+      setattr(sys.modules[parent], name.rsplit('.', 1)[1], sys.modules[name])
+    parent = name
+  sys.modules[HASSAPI_MODULE] = module
+  setattr(sys.modules['appdaemon.plugins.hass'], 'hassapi', module)
+
+
+def create_app(simulator, args, name='auto_lights'):
+  install_hassapi()
+  auto_lights = importlib.import_module('auto_lights')
+  app = auto_lights.AutoLights(simulator, name, args)
+  simulator.call('initialize', app.initialize)
+  simulator.advance(simulator.now)
+  return app
+
+
+def read_stream(path):
+  with open(path, newline='') as stream_file:
+    for row in csv.DictReader(stream_file):
+      yield (datetime.datetime.fromisoformat(row['timestamp']),
+             row['entity_id'], row['old'] or None, row['new'])
+
+
+def generate_stream(entities, start=DEFAULT_START, days=7, seed=0):
+  """Generate motion (on, then off 30s-5m later) for each entity, with
+  events at random intervals of up to an hour (more often in the evening)."""
+  rng = random.Random(seed)
+  stream = []
+  end = start + datetime.timedelta(days=days)
+  for entity_id in entities:
+    now = start
+    while now < end:
+      gap = 3600 if now.hour < 17 else 600
+      now += datetime.timedelta(seconds=rng.randrange(30, gap))
+      stream.append((now, entity_id, 'off', 'on'))
+      now += datetime.timedelta(seconds=rng.randrange(30, 300))
+      stream.append((now, entity_id, 'on', 'off'))
+  stream.sort()
+  return stream
+
+
+def load_config(path, app=None):
+  """Load the app arguments from an AppDaemon style YAML file (optionally
+  from the named app)."""
+  import yaml
+  with open(path) as config_file:
+    config = yaml.safe_load(config_file)
+  return config[app] if app else config
+
+
+def main(config=None, stream=None, days=7, seed=0,
+         service_delay=DEFAULT_SERVICE_DELAY, trace=False):
+  args = config or DEFAULT_CONFIG
+  if stream is None:
+    entities = conditions.extract_entities_from_condition(
+        args.get('trigger_activate_condition', []))
+    stream = generate_stream(sorted(entities), days=days, seed=seed)
+  stream = list(stream)
+  start = stream[0][0] if stream else DEFAULT_START
+
+  simulator = Simulator(start=start, service_delay=service_delay, trace=trace)
+  create_app(simulator, args)
+
+  wall_start = time.perf_counter()
+  simulator.replay(stream)
+  elapsed = time.perf_counter() - wall_start
+
+  print('%i state changes' % len(stream))
+  simulator.stats.report(elapsed, simulator.now - start)
+  return simulator
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--config', help='YAML file of app arguments')
+  parser.add_argument('--app', help='Name of the app within --config')
+  parser.add_argument('--stream', help='CSV of timestamp,entity_id,old,new')
+  parser.add_argument('--days', type=int, default=7)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--service-delay', type=float,
+                      default=DEFAULT_SERVICE_DELAY)
+  parser.add_argument('--trace', action='store_true',
+                      help='Print each service call')
+  args = parser.parse_args()
+
+  main(config=load_config(args.config, args.app) if args.config else None,
+       stream=read_stream(args.stream) if args.stream else None,
+       days=args.days, seed=args.seed, service_delay=args.service_delay,
+       trace=args.trace)
@@ -1,6 +1,8 @@
 import copy
 import appdaemon.plugins.hass.hassapi as hass
 
+import logger
+
 DEFAULT_SERVICE = 'toggle'
 DEFAULT_EVENT = 'zha_event'
 
@@ -20,6 +22,7 @@ KEY_ARGS = 'args'
 
 class Button(hass.Hass):
   def initialize(self):
+    self._logger = logger.Logger(self, self.args.get(logger.CONF_VERBOSITY))
     self.listen_event(
         self.handle_button_event,
         event=self.args.get(KEY_EVENT) or DEFAULT_EVENT,
@@ -39,8 +42,8 @@ class Button(hass.Hass):
     return data
 
   def handle_button_event(self, event_name, data, kwargs):
-    self.log('Received button event: (%s, %s, %s)' % (
-        event_name, data, kwargs))
+    self._logger.debug('Received button event: (%s, %s, %s)',
+        event_name, data, kwargs)
 
     command = data.get(KEY_COMMAND)
     if command not in self.args:
@@ -89,19 +92,19 @@ class Button(hass.Hass):
 
   def turn_on_entities(self, entities_on, **kwargs):
     for entity in entities_on:
-      self.log('Turning on %s with args: %s' % (entity, kwargs))
+      self._logger.info('Turning on %s with args: %s', entity, kwargs)
       super().turn_on(entity, **kwargs)
 
   def turn_off_entities(self, entities_off, **kwargs):
     for entity in entities_off:
-      self.log('Turning off %s' % entity)
+      self._logger.info('Turning off %s', entity)
       super().turn_off(entity)
 
   # Reimplement toggle due to:
   # https://github.com/home-assistant/home-assistant/issues/26808
   def toggle_entities(self, entities_on, entities_off,
                       entities_check, **kwargs):
-    self.log('Toggle: Checking state of %s' % entities_check)
+    self._logger.debug('Toggle: Checking state of %s', entities_check)
     if any([self.get_state(entity) == 'on' for entity in entities_check]):
       self.turn_off_entities(entities_off)
     else:
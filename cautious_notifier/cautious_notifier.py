@@ -3,6 +3,7 @@ import datetime
 import voluptuous as vol
 
 import conditions
+import logger
 
 CONF_SUPPRESS_CONDITION = 'suppress_condition'
 CONF_TRIGGER_CONDITION = 'trigger_condition'
@@ -27,6 +28,8 @@ SCHEMA = vol.Schema({
   vol.Optional(CONF_EVENT_DATA, default={}): {},
   vol.Optional(CONF_WINDOW_SECONDS, default=120): vol.Range(min=0, max=300),
   vol.Optional(CONF_RESET_SECONDS, default=15*60): vol.Range(min=0, max=24*60*60),
+  vol.Optional(logger.CONF_VERBOSITY,
+               default=logger.DEFAULT_VERBOSITY): logger.CONFIG_VERBOSITY_SCHEMA,
 }, extra=vol.ALLOW_EXTRA)
 
 
@@ -37,6 +40,7 @@ class CautiousNotifier(hass.Hass):
     self._last_overall_trigger = None
 
     self._config = SCHEMA(self.args)
+    self._logger = logger.Logger(self, self._config.get(logger.CONF_VERBOSITY))
 
     self._window_seconds = self._config.get(CONF_WINDOW_SECONDS)
     self._reset_seconds = self._config.get(CONF_RESET_SECONDS)
@@ -47,38 +51,54 @@ class CautiousNotifier(hass.Hass):
     self._trigger_condition = self._config.get(CONF_TRIGGER_CONDITION)
     self._disable_condition = self._config.get(CONF_DISABLE_CONDITION)
 
+    # Each suppress/trigger condition is tracked (and so compiled)
+    # individually.
+    self._compiled_suppress_condition = [
+        conditions.compile_condition([condition], reorder=True)
+        for condition in self._suppress_condition]
+    self._compiled_trigger_condition = [
+        conditions.compile_condition([condition], reorder=True)
+        for condition in self._trigger_condition]
+    self._compiled_disable_condition = conditions.compile_condition(
+        self._disable_condition, reorder=True)
+
     self._suppress_evaluation_times = [None] * len(self._suppress_condition)
     self._trigger_evaluation_times = [None] * len(self._trigger_condition)
 
     self._trigger_callback = None
     self._trigger_timeout = None
 
-    for entity in conditions.extract_entities_from_condition(
-        self._suppress_condition):
+    # Entity -> indices of the suppress/trigger conditions that reference it,
+    # so a state change only re-evaluates the conditions it can affect.
+    self._suppress_index = conditions.build_entity_index(
+        self._suppress_condition)
+    self._trigger_index = conditions.build_entity_index(
+        self._trigger_condition)
+
+    for entity in self._suppress_index:
       self.listen_state(self._handle_suppress_state, entity)
 
-    for entity in conditions.extract_entities_from_condition(
-        self._trigger_condition):
+    for entity in self._trigger_index:
       self.listen_state(self._handle_trigger_state, entity)
 
   def _handle_suppress_state(self, entity, attribute, old, new, kwargs):
-    for i in range(0, len(self._suppress_condition)):
+    for i in self._suppress_index.get(entity, ()):
       condition = self._suppress_condition[i]
-      if conditions.evaluate_condition(
-          self, self.datetime(), [condition], triggers={entity: new}):
-        self.log('Suppress condition evaluates true: %s (%s: %s->%s)' % (
-            condition, entity, old, new))
+      if self._compiled_suppress_condition[i](
+          self, self.datetime(), triggers={entity: new}):
+        self._logger.debug('Suppress condition evaluates true: %s (%s: %s->%s)',
+            condition, entity, old, new)
         self._suppress_evaluation_times[i] = self.datetime()
 
   def _handle_trigger_state(self, entity, attribute, old, new, kwargs):
     schedule_evaluation = False
 
-    for i in range(0, len(self._trigger_condition)):
+    for i in self._trigger_index.get(entity, ()):
       condition = self._trigger_condition[i]
-      if conditions.evaluate_condition(
-          self, self.datetime(), [condition], triggers={entity: new}):
-        self.log('Trigger condition evaluates true: %s (%s: %s->%s)' % (
-            condition, entity, old, new))
+      if self._compiled_trigger_condition[i](
+          self, self.datetime(), triggers={entity: new}):
+        self._logger.debug('Trigger condition evaluates true: %s (%s: %s->%s)',
+            condition, entity, old, new)
         self._trigger_evaluation_times[i] = self.datetime()
         schedule_evaluation = True
 
@@ -90,13 +110,13 @@ class CautiousNotifier(hass.Hass):
       kwargs[KEY_REFERENCE] = self.datetime() + datetime.timedelta(
           seconds=self._window_seconds)
 
-      self.log('Scheduling trigger evaluation in %i second(s)...' %
+      self._logger.debug('Scheduling trigger evaluation in %i second(s)...',
           self._window_seconds)
       self._trigger_callback = self.run_in(
           self._trigger, self._window_seconds, **kwargs)
 
   def _trigger(self, kwargs=None):
-    self.log('Evaluating whether or not to fire an event...')
+    self._logger.debug('Evaluating whether or not to fire an event...')
 
     self._trigger_callback = None
     reference = kwargs[KEY_REFERENCE]
@@ -108,8 +128,9 @@ class CautiousNotifier(hass.Hass):
       if eval_time:
         seconds_since_suppress = int((reference - eval_time).total_seconds())
         if seconds_since_suppress <= self._window_seconds:
-          self.log('Suppress condition \'%s\' triggered too recently (%i secs '
-                   'ago), skipping...' % (condition, seconds_since_suppress))
+          self._logger.info('Suppress condition \'%s\' triggered too recently '
+                            '(%i secs ago), skipping...',
+                            condition, seconds_since_suppress)
           return False
 
     for i in range(0, len(self._trigger_condition)):
@@ -117,18 +138,20 @@ class CautiousNotifier(hass.Hass):
       eval_time = self._trigger_evaluation_times[i]
 
       if not eval_time:
-        self.log('Trigger condition \'%s\' has not yet triggered, skipping ...'
-            % condition)
+        self._logger.info(
+            'Trigger condition \'%s\' has not yet triggered, skipping ...',
+            condition)
         return False
       seconds_since_trigger = int((reference - eval_time).total_seconds())
       if seconds_since_trigger > self._window_seconds:
-        self.log('Trigger condition \'%s\' triggered too long ago (%i secs ago), '
-                 'skipping...' % (condition, seconds_since_trigger))
+        self._logger.info('Trigger condition \'%s\' triggered too long ago '
+                          '(%i secs ago), skipping...',
+                          condition, seconds_since_trigger)
         return False
 
-    if self._disable_condition and conditions.evaluate_condition(
-        self, self.datetime(), self._disable_condition):
-      self.log('Disable condition \'%s\' evalutes true, skipping...' %
+    if self._disable_condition and self._compiled_disable_condition(
+        self, self.datetime()):
+      self._logger.info('Disable condition \'%s\' evalutes true, skipping...',
           self._disable_condition)
       return False
 
@@ -136,11 +159,11 @@ class CautiousNotifier(hass.Hass):
       seconds_since_overall_trigger = int((self.datetime() -
           self._last_overall_trigger).total_seconds())
       if seconds_since_overall_trigger < self._reset_seconds:
-        self.log('Overall trigger was too recent (%i secs ago), '
-                 'skipping...' % seconds_since_overall_trigger)
+        self._logger.info('Overall trigger was too recent (%i secs ago), '
+                          'skipping...', seconds_since_overall_trigger)
         return False
 
     self._last_overall_trigger = self.datetime()
     self.fire_event(self._event, **self._event_data)
-    self.log('Triggered! Fired event: \'%s\' with data \'%s\'' % (
-        self._event, self._event_data))
+    self._logger.info('Triggered! Fired event: \'%s\' with data \'%s\'',
+        self._event, self._event_data)
@@ -1,4 +1,8 @@
+import collections
 import datetime
+import operator as op
+import threading
+import weakref
 import voluptuous as vol
 
 KEY_DEBUG = 'debug'
@@ -19,36 +23,96 @@ VALID_KINDS = [CONF_KIND_STATE, CONF_KIND_TRIGGER]
 
 VALID_DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
 
+# Order matters: '<=' must be matched before '<'.
+NUMERIC_OPERATORS = (
+  ('<=', op.le),
+  ('<', op.lt),
+  ('>=', op.ge),
+  ('>', op.gt),
+)
+
+class NumericCondition(collections.namedtuple(
+    'NumericCondition', ['operator', 'rval', 'text'])):
+  """A pre-parsed numeric comparison, e.g. '<=40' -> (op.le, 40.0)."""
+  def __str__(self):
+    return self.text
+
+def ConstrainTime(fmt='%H:%M:%S'):
+  """Parse fixed clock times into datetime.time at validation time.
+
+  Anything else (e.g. 'sunset + 00:30') is left as a string, to be resolved
+  via the app when the condition is evaluated."""
+  def validator(v):
+    v = v.strip()
+    try:
+      return datetime.datetime.strptime(v, fmt).time()
+    except ValueError:
+      return v
+  return validator
+
 def ConstrainTimeRange(fmt='%H:%M:%S'):
-  return lambda v: tuple([
-      v.split('->')[0].strip(),
-      v.split('->')[1].strip()])
+  constrain_time = ConstrainTime(fmt)
+  def validator(v):
+    parts = v.split('->')
+    if len(parts) != 2:
+      raise vol.Invalid('Time range must be of the form \'start -> end\'')
+    return tuple(constrain_time(part) for part in parts)
+  return validator
+
+class DayMask(int):
+  """Days of the week as a 7-bit mask, bit N set for weekday() == N."""
+  def __str__(self):
+    return ','.join(day for i, day in enumerate(VALID_DAYS) if self & (1 << i))
+
+def ConstrainDays():
+  """Convert a day (or list of days) into a DayMask at validation time."""
+  def validator(v):
+    days = v if type(v) == list else [v]
+    return DayMask(sum(1 << VALID_DAYS.index(day) for day in set(days)))
+  return validator
+
+def ConstrainStateCondition():
+  """Parse numeric comparisons (e.g. '<=40') into NumericConditions at
+  validation time, rejecting those with a non-numeric rval."""
+  def validator(v):
+    if type(v) == bool:
+      return v
+    for text, operator in NUMERIC_OPERATORS:
+      if v.startswith(text):
+        try:
+          return NumericCondition(operator, float(v[len(text):]), v)
+        except ValueError:
+          raise vol.Invalid(
+              'Could not convert \'%s\' to rval float in condition' % (
+                  v[len(text):]))
+    return v
+  return validator
 
 CONFIG_CONDITION_BASE_SCHEMA = {
   vol.Optional(CONF_OR): vol.Self,
   vol.Optional(CONF_AND): vol.Self,
   vol.Optional(CONF_NOT): vol.Self,
-  vol.Optional(CONF_AFTER): str,
-  vol.Optional(CONF_BEFORE): str,
-  vol.Optional(CONF_BETWEEN): ConstrainTimeRange(),
-  vol.Optional(CONF_DAY):
+  vol.Optional(CONF_AFTER): vol.All(str, ConstrainTime()),
+  vol.Optional(CONF_BEFORE): vol.All(str, ConstrainTime()),
+  vol.Optional(CONF_BETWEEN): vol.All(str, ConstrainTimeRange()),
+  vol.Optional(CONF_DAY): vol.All(
       vol.Any(vol.All(vol.Lower, vol.In(VALID_DAYS)),
               [vol.All(vol.Lower, vol.In(VALID_DAYS))]),
+      ConstrainDays()),
   vol.Optional(CONF_KIND, default=DEFAULT_KIND): vol.In(VALID_KINDS),
-  str: vol.Any(str, bool),
+  str: vol.All(vol.Any(str, bool), ConstrainStateCondition()),
 }
 
 def evaluator_AND_OR(app, current_datetime, key, condition, triggers,
                      evaluators, default_evaluator, operator, kind, **kwargs):
-  return evaluate_condition(
-      app, current_datetime, condition, triggers,
-      evaluators, default_evaluator, key, kind, **kwargs)
+  return _get_compiled_set(condition, evaluators, default_evaluator, key)(
+      app, current_datetime, triggers, kwargs)
 
 def evaluator_NOT(app, current_datetime, key, condition, triggers,
                   evaluators, default_evaluator, operator, kind, **kwargs):
-  return not evaluate_condition(
-      app, current_datetime, condition, triggers,
-      evaluators, default_evaluator, operator, kind, **kwargs)
+  return not _get_compiled_set(
+      condition, evaluators, default_evaluator, operator)(
+          app, current_datetime, triggers, kwargs)
 
 def _parse_datetime(app, condition, key):
   try:
@@ -59,81 +123,87 @@ def _parse_datetime(app, condition, key):
              "always evaluate false: key='%s'" % (condition, key))
   return None
 
-def _parse_time(app, condition, key):
+# Symbolic times (e.g. 'sunset + 00:30') resolved via the app, keyed on
+# app -> condition -> (expiry datetime, time). Apps are weakly referenced, so
+# that the cache does not keep them alive across AppDaemon reloads.
+_symbolic_time_cache = weakref.WeakKeyDictionary()
+
+def _get_symbolic_time_expiry(app, current_datetime):
+  # Resolved symbolic times are valid until midnight, or until the next sun
+  # event (after which sunrise/sunset refer to the following day).
+  expiry = datetime.datetime.combine(
+      current_datetime.date() + datetime.timedelta(days=1), datetime.time())
+  for sun_event in (app.sunrise(), app.sunset()):
+    if current_datetime < sun_event < expiry:
+      expiry = sun_event
+  return expiry
+
+def _parse_time(app, current_datetime, condition, key):
+  if type(condition) == datetime.time:
+    return condition
+
+  if isinstance(app, StateSnapshot):
+    app = app._app
+  app_cache = _symbolic_time_cache.setdefault(app, {})
+  cached = app_cache.get(condition)
+  if cached is not None and current_datetime < cached[0]:
+    return cached[1]
+
   dt = _parse_datetime(app, condition, key)
-  return dt.time() if dt else None
+  value = dt.time() if dt else None
+  app_cache[condition] = (
+      _get_symbolic_time_expiry(app, current_datetime), value)
+  return value
 
 def evaluator_BEFORE(app, current_datetime, key, condition, triggers,
                      evaluators, default_evaluator, operator, kind, **kwargs):
-  val = _parse_time(app, condition, key)
+  val = _parse_time(app, current_datetime, condition, key)
   if val is None:
     return False
   return current_datetime.time() < val
 
 def evaluator_AFTER(app, current_datetime, key, condition, triggers,
                     evaluators, default_evaluator, operator, kind, **kwargs):
-  val = _parse_time(app, condition, key)
+  val = _parse_time(app, current_datetime, condition, key)
   if val is None:
     return False
   return current_datetime.time() >= val
 
 def evaluator_DAY(app, current_datetime, key, condition, triggers,
                   evaluators, default_evaluator, operator, kind, **kwargs):
-  current_day = current_datetime.strftime('%a').lower()
-  if type(condition) == list:
-    return current_day in condition
-  return current_day == condition
+  return bool(condition & (1 << current_datetime.weekday()))
 
 def evaluator_BETWEEN(app, current_datetime, key, condition, triggers,
                       evaluators, default_evaluator, operator, kind, **kwargs):
-  start = _parse_time(app, condition[0], key)
-  end = _parse_time(app, condition[1], key)
+  start = _parse_time(app, current_datetime, condition[0], key)
+  end = _parse_time(app, current_datetime, condition[1], key)
 
   if start is None or end is None:
     return False
+  current_time = current_datetime.time()
   if start < end:
-    return start <= current_datetime.time() < end
+    return start <= current_time < end
   else:
-    return start <= current_datetime.time() or current_datetime.time() < end
+    return start <= current_time or current_time < end
 
 def evaluator_DEFAULT(app, current_datetime, key, condition, triggers,
                       evaluators, default_evaluator, operator, kind, **kwargs):
-  if type(condition) == str:
-    for numeric_operator in ('<=', '<', '>=', '>'):
-      if condition.startswith(numeric_operator):
-        if kind == CONF_KIND_TRIGGER:
-          if key not in triggers:
-            return False
-          lval_str = triggers[key]
-        else:
-          lval_str = app.get_state(key)
-        rval_str =  condition[len(numeric_operator):]
+  if type(condition) == NumericCondition:
+    if kind == CONF_KIND_TRIGGER:
+      if key not in triggers:
+        return False
+      lval_str = triggers[key]
+    else:
+      lval_str = app.get_state(key)
 
-        try:
-          rval = float(rval_str)
-        except ValueError:
-          app.log("Warning: Could not convert '%s' to rval float in condition "
-                  "evaluation. Configuration is incorrect. Condition will "
-                  "always evaluate false: key='%s', condition='%s'" % (
-              (rval_str, key, condition)))
-          return False
-
-        try:
-          lval = float(lval_str)
-        except ValueError:
-          app.log("Warning: Could not convert '%s' to lval float in condition "
-                  "evaluation. Condition will always evaluate false: "
-                  "key='%s', condition='%s'" % (lval_str, key, condition))
-          return False
-
-        if numeric_operator == '<=':
-          return lval <= rval
-        elif numeric_operator == '<':
-          return lval < rval
-        elif numeric_operator == '>':
-          return lval > rval
-        else: # >=
-          return lval >= rval
+    try:
+      lval = float(lval_str)
+    except (TypeError, ValueError):
+      app.log("Warning: Could not convert '%s' to lval float in condition "
+              "evaluation. Condition will always evaluate false: "
+              "key='%s', condition='%s'" % (lval_str, key, condition))
+      return False
+    return condition.operator(lval, condition.rval)
   if kind == CONF_KIND_TRIGGER:
     return key in triggers and (triggers[key] == str(condition) or condition == '*')
   else:
@@ -149,42 +219,298 @@ BASE_EVALUATORS = {
   CONF_DAY: evaluator_DAY,
 }
 
+# Relative evaluation costs, used to optionally reorder conditions so that
+# cheap, pure checks are evaluated before those that require get_state().
+COST_CHEAP = 1
+COST_STATE = 10
+
+BASE_COSTS = {
+  CONF_AFTER: COST_CHEAP,
+  CONF_BEFORE: COST_CHEAP,
+  CONF_BETWEEN: COST_CHEAP,
+  CONF_DAY: COST_CHEAP,
+}
+
+def _get_leaf_cost(key, kind, costs):
+  if key in costs:
+    return costs[key]
+  # Trigger kinds are a lookup in the triggers dict, everything else is
+  # assumed to need the entity state.
+  return COST_CHEAP if kind == CONF_KIND_TRIGGER else COST_STATE
+
+def _compile_leaf(key, condition, kind, evaluators, default_evaluator,
+                  operator, costs, shared=None):
+  """Returns (callable, number of leaves, cost)."""
+  if shared is not None:
+    subexpression = _get_subexpression_key(key, condition, kind, operator)
+    if subexpression in shared.nodes:
+      return shared.nodes[subexpression]
+
+  evaluator = evaluators.get(key, default_evaluator)
+
+  # The logical operators are compiled structurally, rather than being
+  # dispatched through their evaluator on every call.
+  if evaluator is evaluator_AND_OR:
+    compiled = _compile_set(
+        condition, evaluators, default_evaluator, key, costs, shared)
+  elif evaluator is evaluator_NOT:
+    inner, leaves, cost = _compile_set(
+        condition, evaluators, default_evaluator, operator, costs, shared)
+    compiled = (lambda app, current_datetime, triggers, kwargs: not inner(
+        app, current_datetime, triggers, kwargs)), leaves, cost
+  else:
+    def leaf(app, current_datetime, triggers, kwargs):
+      value = evaluator(
+          app, current_datetime, key, condition, triggers,
+          evaluators, default_evaluator, operator, kind, **kwargs)
+      if kwargs.get(KEY_DEBUG):
+        app.log('----- Evaluator: (%s:%s:%s) -> %s' % (
+            kind, key, condition, value))
+      return value
+    compiled = leaf, 1, _get_leaf_cost(key, kind, costs or BASE_COSTS)
+
+  if shared is not None:
+    compiled = shared.add(subexpression, compiled)
+  return compiled
+
+def _compile_set(condition_set, evaluators, default_evaluator, operator,
+                 costs, shared=None):
+  """Returns (callable, number of leaves, cost)."""
+  if operator not in (CONF_AND, CONF_OR):
+    raise RuntimeError('Invalid operator: %s' % operator)
+
+  compiled = [
+      _compile_leaf(key, condition[key], condition[CONF_KIND],
+                    evaluators, default_evaluator, operator, costs, shared)
+      for condition in condition_set
+      for key in condition if key != CONF_KIND]
+  if costs is not None:
+    compiled.sort(key=lambda x: x[2])
+
+  leaves = sum(x[1] for x in compiled)
+  cost = sum(x[2] for x in compiled)
+
+  if not compiled:
+    return (lambda app, current_datetime, triggers, kwargs: True), 0, 0
+  elif len(compiled) == 1:
+    return compiled[0]
+
+  children = tuple(x[0] for x in compiled)
+  # skipped[i] is the number of leaves not evaluated if the result is
+  # decided by children[i].
+  skipped = tuple(sum(x[1] for x in compiled[i+1:])
+                  for i in range(len(compiled)))
+  decisive = operator == CONF_OR
+
+  def node(app, current_datetime, triggers, kwargs):
+    for i, child in enumerate(children):
+      if bool(child(app, current_datetime, triggers, kwargs)) == decisive:
+        if kwargs.get(KEY_DEBUG) and skipped[i]:
+          app.log('----- Short-circuit (%s): %i leaves skipped' % (
+              operator, skipped[i]))
+        return decisive
+    return not decisive
+  return node, leaves, cost
+
+def compile_condition(condition_set,
+                      evaluators=BASE_EVALUATORS,
+                      default_evaluator=evaluator_DEFAULT,
+                      operator=CONF_AND,
+                      reorder=False,
+                      costs=BASE_COSTS):
+  """Compile a validated condition set into a callable.
+
+  The returned callable has the signature
+  (app, current_datetime, triggers=None, **kwargs) and returns the same value
+  evaluate_condition() would for the same arguments. Compile once (e.g. at
+  config load) and call it on every evaluation.
+
+  And/or evaluation short-circuits. If reorder is True, the conditions at
+  each level are sorted by their cost (see costs) so that cheap checks run
+  before those that require get_state()."""
+  return _wrap_root(_compile_set(
+      condition_set, evaluators, default_evaluator, operator,
+      costs if reorder else None)[0])
+
+def _wrap_root(root):
+  def compiled(app, current_datetime, triggers=None, snapshot=None,
+               **kwargs):
+    if snapshot is not None:
+      app = snapshot
+    return root(app, current_datetime, triggers, kwargs)
+  return compiled
+
+# Condition sets compiled for evaluate_condition() (and the and/or/not
+# evaluators), keyed on the identity of the set, its evaluators and operator.
+# Each entry references its key objects so that their ids are not reused while
+# it is cached. Validated condition sets are not modified, so entries do not
+# go stale.
+EVALUATE_CACHE_SIZE = 128
+_compiled_set_cache = collections.OrderedDict()
+_compiled_set_cache_lock = threading.Lock()
+
+def _get_compiled_set(condition_set, evaluators, default_evaluator, operator):
+  cache_key = (id(condition_set), id(evaluators), id(default_evaluator),
+               operator)
+  with _compiled_set_cache_lock:
+    cached = _compiled_set_cache.get(cache_key)
+    if cached is not None:
+      _compiled_set_cache.move_to_end(cache_key)
+      return cached[-1]
+
+  root = _compile_set(
+      condition_set, evaluators, default_evaluator, operator, None)[0]
+  with _compiled_set_cache_lock:
+    _compiled_set_cache[cache_key] = (
+        condition_set, evaluators, default_evaluator, root)
+    if len(_compiled_set_cache) > EVALUATE_CACHE_SIZE:
+      _compiled_set_cache.popitem(last=False)
+  return root
+
 def evaluate_condition(app, current_datetime, condition_set,
                        triggers=None,
                        evaluators=BASE_EVALUATORS,
                        default_evaluator=evaluator_DEFAULT, operator=CONF_AND,
                        kind=CONF_KIND_STATE,
+                       snapshot=None,
                        **kwargs):
-  value = None
-  for condition in condition_set:
-    kind = condition[CONF_KIND]
-    for key in {k:v for (k, v) in condition.items() if k != CONF_KIND}:
-      if key in evaluators:
-        intermediate_value = evaluators[key](
-            app, current_datetime, key, condition[key], triggers,
-            evaluators, default_evaluator, operator, kind, **kwargs)
-      else:
-        intermediate_value = default_evaluator(
-            app, current_datetime, key, condition[key], triggers,
-            evaluators, default_evaluator, operator, kind, **kwargs)
-
-      if KEY_DEBUG in kwargs and kwargs[DEBUG] == True:
-        app.log('----- Evaluator: (%s:%s:%s) -> %s' % (
-            kind, key, condition[key], intermediate_value))
-
-      if value is None:
-        value = intermediate_value
-      elif operator == CONF_AND:
-        value &= intermediate_value
-      elif operator == CONF_OR:
-        value |= intermediate_value
-      else:
-        raise RuntimeError('Invalid operator: %s' % operator)
+  if snapshot is not None:
+    app = snapshot
+  return _get_compiled_set(
+      condition_set, evaluators, default_evaluator, operator)(
+          app, current_datetime, triggers, kwargs)
 
-  if value is None:
-    value = True
+def _freeze(value):
+  if type(value) == list:
+    return tuple(_freeze(item) for item in value)
+  elif type(value) == dict:
+    return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
   return value
 
+def _get_subexpression_key(key, condition, kind, operator):
+  return (key, _freeze(condition), kind, operator)
+
+class _SharedSubexpressions(object):
+  """Identical subexpressions across the condition sets passed to
+  compile_many() are compiled once. Those that occur more than once have
+  their result memoized for the duration of each evaluate_many() call."""
+  def __init__(self, condition_sets, evaluators, default_evaluator, operator):
+    self._evaluators = evaluators
+    self._default_evaluator = default_evaluator
+    self.counts = {}
+    self.nodes = {}
+    for condition_set in condition_sets:
+      self._count(condition_set, operator)
+
+  def _count(self, condition_set, operator):
+    for condition in condition_set:
+      for key in condition:
+        if key == CONF_KIND:
+          continue
+        subexpression = _get_subexpression_key(
+            key, condition[key], condition[CONF_KIND], operator)
+        self.counts[subexpression] = self.counts.get(subexpression, 0) + 1
+        if self.counts[subexpression] > 1:
+          # Repeats reuse the same node, so its children are not repeated.
+          continue
+        evaluator = self._evaluators.get(key, self._default_evaluator)
+        if evaluator is evaluator_AND_OR:
+          self._count(condition[key], key)
+        elif evaluator is evaluator_NOT:
+          self._count(condition[key], operator)
+
+  def add(self, subexpression, compiled):
+    if self.counts.get(subexpression, 0) > 1:
+      node, leaves, cost = compiled
+      compiled = _memoize(node, len(self.nodes)), leaves, cost
+    self.nodes[subexpression] = compiled
+    return compiled
+
+def _memoize(node, node_id):
+  def memoized(app, current_datetime, triggers, kwargs):
+    results = app._results if type(app) == StateSnapshot else None
+    if results is None:
+      return node(app, current_datetime, triggers, kwargs)
+    if node_id not in results:
+      results[node_id] = node(app, current_datetime, triggers, kwargs)
+    return results[node_id]
+  return memoized
+
+def compile_many(condition_sets,
+                 evaluators=BASE_EVALUATORS,
+                 default_evaluator=evaluator_DEFAULT,
+                 operator=CONF_AND,
+                 reorder=False,
+                 costs=BASE_COSTS):
+  """Compile a list of condition sets for use with evaluate_many().
+
+  Returns a list of compiled conditions (as compile_condition()), in which
+  subexpressions common to several sets are shared."""
+  shared = _SharedSubexpressions(
+      condition_sets, evaluators, default_evaluator, operator)
+  compiled = []
+  for condition_set in condition_sets:
+    root = _compile_set(condition_set, evaluators, default_evaluator,
+                        operator, costs if reorder else None, shared)[0]
+    compiled.append(_wrap_root(root))
+  return compiled
+
+def evaluate_many(condition_sets, snapshot, first_match=False,
+                  current_datetime=None, triggers=None, **kwargs):
+  """Evaluate compiled condition sets (see compile_many()) against a single
+  StateSnapshot, in one pass.
+
+  Entity states, resolved times and shared subexpressions are computed at
+  most once. Returns a list of the results or, if first_match is True, the
+  index of the first set that evaluates true (None if there is none)."""
+  if current_datetime is None:
+    current_datetime = snapshot.datetime()
+
+  snapshot._results = {}
+  try:
+    if not first_match:
+      return [condition(snapshot, current_datetime, triggers, **kwargs)
+              for condition in condition_sets]
+    for i, condition in enumerate(condition_sets):
+      if condition(snapshot, current_datetime, triggers, **kwargs):
+        return i
+    return None
+  finally:
+    snapshot._results = None
+
+class StateSnapshot(object):
+  """Memoizes app.get_state() for the duration of one logical evaluation
+  (e.g. a single callback), so each entity is read at most once.
+
+  Pass as snapshot= to a compiled condition (or evaluate_condition). All
+  other attribute access is delegated to the app. States already known to
+  the caller (e.g. the new state in a listen_state callback) may be supplied
+  as a dict of entity_id -> state."""
+  def __init__(self, app, states=None):
+    self._app = app
+    self._states = {
+        (entity_id, ()): state
+        for entity_id, state in (states or {}).items()}
+    # Memoized subexpression results, only set during evaluate_many().
+    self._results = None
+    self.hits = 0
+    self.misses = 0
+
+  def get_state(self, entity_id=None, **kwargs):
+    key = (entity_id, tuple(sorted(kwargs.items())))
+    if key in self._states:
+      self.hits += 1
+      return self._states[key]
+    self.misses += 1
+    state = self._states[key] = self._app.get_state(entity_id, **kwargs)
+    return state
+
+  def __getattr__(self, name):
+    return getattr(self._app, name)
+
+  def __repr__(self):
+    return '<StateSnapshot:hits=%i,misses=%i>' % (self.hits, self.misses)
+
 def extractor_AND_OR_NOT(key, condition, extractors, default_extractor):
   return extract_entities_from_condition(
       condition, extractors, default_extractor)
@@ -202,18 +528,277 @@ BASE_EXTRACTORS = {
   CONF_AFTER: extractor_NULL,
   CONF_BEFORE: extractor_NULL,
   CONF_BETWEEN: extractor_NULL,
+  CONF_DAY: extractor_NULL,
 }
 
 def extract_entities_from_condition(
     condition_set, extractors=BASE_EXTRACTORS,
     default_extractor=extractor_DEFAULT):
+  """Return the entities referenced by condition_set, without duplicates (in
+  order of first reference)."""
   entities = []
   for condition in condition_set:
-    for key in {k:v for (k, v) in condition.items() if k != CONF_KIND}:
-      if key in extractors:
-        entities.extend(extractors[key](
-            key, condition[key], extractors, default_extractor))
-      else:
-        entities.extend(default_extractor(
-            key, condition[key], extractors, default_extractor))
+    for key in condition:
+      if key == CONF_KIND:
+        continue
+      extractor = extractors.get(key, default_extractor)
+      for entity in extractor(
+          key, condition[key], extractors, default_extractor):
+        if entity not in entities:
+          entities.append(entity)
   return entities
+
+def _is_trigger_only(condition_set, extractors, negated=False):
+  """Whether every leaf in condition_set is a non-negated trigger leaf."""
+  for condition in condition_set:
+    for key in condition:
+      if key == CONF_KIND:
+        continue
+      if key in (CONF_AND, CONF_OR, CONF_NOT):
+        if not _is_trigger_only(
+            condition[key], extractors, negated or key == CONF_NOT):
+          return False
+      elif (negated or key in extractors or
+            condition[CONF_KIND] != CONF_KIND_TRIGGER):
+        return False
+  return True
+
+def build_entity_index(
+    condition_set, extractors=BASE_EXTRACTORS,
+    default_extractor=extractor_DEFAULT):
+  """Map each referenced entity to the indices (into condition_set) of the
+  conditions that depend on it.
+
+  A state change for an entity then only needs the conditions at those
+  indices re-evaluated. Only conditions made up entirely of (non-negated)
+  trigger leaves can be indexed, as they can only be true when one of their
+  own entities changes. All other conditions (e.g. reading the state of
+  other entities, or purely time based) are included for every entity, as
+  they would otherwise not be re-evaluated when another entity changes."""
+  index = {}
+  unbound = []
+  for i, condition in enumerate(condition_set):
+    entities = extract_entities_from_condition(
+        [condition], extractors, default_extractor)
+    if not entities or not _is_trigger_only([condition], extractors):
+      unbound.append(i)
+    for entity in entities:
+      index.setdefault(entity, []).append(i)
+
+  return {
+      entity: tuple(sorted(set(indices + unbound)))
+      for entity, indices in index.items()}
+
+TIME_KEYS = (CONF_AFTER, CONF_BEFORE, CONF_BETWEEN, CONF_DAY)
+
+def _get_leaf_time_boundary(app, current_datetime, key, condition):
+  """Return the next datetime at which a time leaf may change value."""
+  # Day changes happen at midnight, which is also when symbolic times
+  # (e.g. sunset) are next re-resolved.
+  boundary = datetime.datetime.combine(
+      current_datetime.date() + datetime.timedelta(days=1), datetime.time())
+  if key == CONF_DAY:
+    return boundary
+
+  times = condition if key == CONF_BETWEEN else (condition,)
+  for time_condition in times:
+    value = _parse_time(app, current_datetime, time_condition, key)
+    if value is None:
+      continue
+    candidate = datetime.datetime.combine(current_datetime.date(), value)
+    if candidate <= current_datetime:
+      candidate += datetime.timedelta(days=1)
+    boundary = min(boundary, candidate)
+  return boundary
+
+def get_next_time_boundary(app, current_datetime, condition_set):
+  """Return the next datetime at which the time conditions in condition_set
+  may change value, or None if there are none."""
+  boundary = None
+  for condition in condition_set:
+    for key in condition:
+      if key in (CONF_AND, CONF_OR, CONF_NOT):
+        candidate = get_next_time_boundary(
+            app, current_datetime, condition[key])
+      elif key in TIME_KEYS:
+        candidate = _get_leaf_time_boundary(
+            app, current_datetime, key, condition[key])
+      else:
+        continue
+      if candidate is not None and (boundary is None or candidate < boundary):
+        boundary = candidate
+  return boundary
+
+class _IncrementalNode(object):
+  __slots__ = ('parent', 'value', 'operator', 'children', 'true_count',
+               'negate', 'evaluate', 'key', 'condition')
+
+  def __init__(self, parent, operator=None, negate=False, evaluate=None,
+               key=None, condition=None):
+    self.parent = parent
+    self.value = None
+    self.operator = operator
+    self.children = []
+    self.true_count = 0
+    self.negate = negate
+    self.evaluate = evaluate
+    self.key = key
+    self.condition = condition
+
+  def get_group_value(self):
+    if not self.children:
+      return True
+    elif self.operator == CONF_AND:
+      return self.true_count == len(self.children)
+    return self.true_count > 0
+
+class IncrementalCondition(object):
+  """Maintains the truth value of a condition set as entity states change.
+
+  Every leaf is evaluated once on creation. Thereafter update() re-evaluates
+  only the leaves that reference the changed entity, and propagates any
+  change up towards the root. Time based leaves are re-evaluated by a timer
+  armed for the next boundary crossing, rather than by polling. Reading
+  value is O(1).
+
+  The condition set is evaluated without triggers (i.e. trigger kinds are
+  always false)."""
+  def __init__(self, app, condition_set,
+               evaluators=BASE_EVALUATORS,
+               default_evaluator=evaluator_DEFAULT,
+               extractors=BASE_EXTRACTORS,
+               default_extractor=extractor_DEFAULT):
+    self._app = app
+    self._evaluators = evaluators
+    self._default_evaluator = default_evaluator
+    self._extractors = extractors
+    self._default_extractor = default_extractor
+
+    # entity_id -> leaves referencing it.
+    self._entity_leaves = {}
+    # Leaves that depend on the time.
+    self._time_leaves = []
+    # Leaves that depend on neither (e.g. custom evaluators), re-evaluated
+    # on every update.
+    self._volatile_leaves = []
+    self._timer_handle = None
+
+    self._root = _IncrementalNode(None, operator=CONF_AND)
+    self._build(self._root, condition_set, CONF_AND)
+    self.refresh()
+
+  @property
+  def value(self):
+    return self._root.value
+
+  @property
+  def entities(self):
+    return list(self._entity_leaves)
+
+  def _build(self, group, condition_set, operator):
+    for condition in condition_set:
+      kind = condition[CONF_KIND]
+      for key in condition:
+        if key == CONF_KIND:
+          continue
+        evaluator = self._evaluators.get(key, self._default_evaluator)
+        if evaluator is evaluator_AND_OR:
+          child = _IncrementalNode(group, operator=key)
+          self._build(child, condition[key], key)
+        elif evaluator is evaluator_NOT:
+          child = _IncrementalNode(group, negate=True)
+          inner = _IncrementalNode(child, operator=operator)
+          child.children.append(inner)
+          self._build(inner, condition[key], operator)
+        else:
+          child = self._build_leaf(
+              group, key, condition[key], kind, operator)
+        group.children.append(child)
+
+  def _build_leaf(self, group, key, condition, kind, operator):
+    leaf = _IncrementalNode(
+        group, key=key, condition=condition,
+        evaluate=_compile_leaf(key, condition, kind, self._evaluators,
+                               self._default_evaluator, operator, None)[0])
+
+    entities = self._extractors.get(key, self._default_extractor)(
+        key, condition, self._extractors, self._default_extractor)
+    for entity_id in entities:
+      self._entity_leaves.setdefault(entity_id, []).append(leaf)
+    if key in TIME_KEYS:
+      self._time_leaves.append(leaf)
+    elif not entities:
+      self._volatile_leaves.append(leaf)
+    return leaf
+
+  def _initialize(self, node, app, current_datetime):
+    if node.evaluate is not None:
+      node.value = bool(node.evaluate(app, current_datetime, {}, {}))
+      return
+    for child in node.children:
+      self._initialize(child, app, current_datetime)
+    if node.negate:
+      node.value = not node.children[0].value
+    else:
+      node.true_count = sum(1 for child in node.children if child.value)
+      node.value = node.get_group_value()
+
+  def _set_leaf(self, leaf, value):
+    node = leaf
+    while node.value != value:
+      node.value = value
+      parent = node.parent
+      if parent is None:
+        return
+      if parent.negate:
+        value = not value
+      else:
+        parent.true_count += 1 if value else -1
+        value = parent.get_group_value()
+      node = parent
+
+  def _evaluate_leaves(self, leaves, app, current_datetime):
+    for leaf in leaves:
+      self._set_leaf(leaf, bool(leaf.evaluate(app, current_datetime, {}, {})))
+
+  def refresh(self):
+    """Re-evaluate every leaf from scratch, and re-arm the time boundary
+    timer."""
+    current_datetime = self._app.datetime()
+    self._initialize(self._root, StateSnapshot(self._app), current_datetime)
+    self._arm_timer(current_datetime)
+    return self.value
+
+  def update(self, entity_id, new=None):
+    """Re-evaluate the leaves that reference entity_id (e.g. from a
+    listen_state callback, with new as its new state)."""
+    app = StateSnapshot(self._app, states=(
+        {entity_id: new} if new is not None else None))
+    current_datetime = self._app.datetime()
+    self._evaluate_leaves(
+        self._entity_leaves.get(entity_id, ()), app, current_datetime)
+    self._evaluate_leaves(self._volatile_leaves, app, current_datetime)
+    return self.value
+
+  def cancel(self):
+    if self._timer_handle is not None:
+      self._app.cancel_timer(self._timer_handle)
+      self._timer_handle = None
+
+  def _arm_timer(self, current_datetime):
+    self.cancel()
+    if not self._time_leaves:
+      return
+    boundary = min(
+        _get_leaf_time_boundary(
+            self._app, current_datetime, leaf.key, leaf.condition)
+        for leaf in self._time_leaves)
+    self._timer_handle = self._app.run_at(self._time_callback, boundary)
+
+  def _time_callback(self, kwargs):
+    self._timer_handle = None
+    current_datetime = self._app.datetime()
+    app = StateSnapshot(self._app)
+    self._evaluate_leaves(self._time_leaves, app, current_datetime)
+    self._evaluate_leaves(self._volatile_leaves, app, current_datetime)
+    self._arm_timer(current_datetime)
@@ -0,0 +1,274 @@
+"""Benchmark harness for conditions.py.
+
+Runs generated condition trees (of configurable depth, width and entity
+count) against an in-memory fake app, reporting ops/sec and tracemalloc
+allocations for each evaluation path:
+
+  - interpreted: a reference tree-walking interpreter (the pre-compilation
+    implementation of evaluate_condition).
+  - evaluate_condition: the ad-hoc path (compiled on the first call, then
+    cached per condition set).
+  - compiled / compiled+reorder / compiled+snapshot: compile_condition().
+  - extract_entities_from_condition / build_entity_index.
+
+It also compares the day bitmask against the previous strftime based day
+check. No AppDaemon is required. Run directly, e.g.:
+
+  python conditions_benchmark.py --depth 5 --width 4 --entities 20
+"""
+
+import argparse
+import datetime
+import gc
+import random
+import re
+import timeit
+import tracemalloc
+
+import voluptuous as vol
+
+import conditions
+
+CONDITION_SCHEMA = vol.Schema([conditions.CONFIG_CONDITION_BASE_SCHEMA])
+
+ENTITY_FORMAT = 'sensor.entity_%i'
+STATE_VALUES = ['on', 'off', '5', '50', 'unavailable']
+SYMBOLIC_TIME_RE = re.compile(
+    r'^(sunrise|sunset)\s*(?:([+-])\s*(\d+):(\d+)(?::(\d+))?)?$')
+
+
+class FakeApp(object):
+  """An in-memory stand-in for the AppDaemon API used by conditions.py."""
+  def __init__(self, states, now=None):
+    self._states = states
+    self._now = now or datetime.datetime.now()
+    self.get_state_calls = 0
+
+  def get_state(self, entity_id=None, **kwargs):
+    self.get_state_calls += 1
+    if entity_id is None:
+      return dict(self._states)
+    return self._states.get(entity_id)
+
+  def datetime(self):
+    return self._now
+
+  def sunrise(self):
+    return self._next(datetime.time(6, 30))
+
+  def sunset(self):
+    return self._next(datetime.time(18, 45))
+
+  def _next(self, value):
+    candidate = datetime.datetime.combine(self._now.date(), value)
+    if candidate <= self._now:
+      candidate += datetime.timedelta(days=1)
+    return candidate
+
+  def parse_datetime(self, value):
+    match = SYMBOLIC_TIME_RE.match(value.strip())
+    if not match:
+      return datetime.datetime.combine(
+          self._now.date(),
+          datetime.datetime.strptime(value.strip(), '%H:%M:%S').time())
+    event, sign, hours, minutes, seconds = match.groups()
+    result = self.sunrise() if event == 'sunrise' else self.sunset()
+    if sign:
+      offset = datetime.timedelta(
+          hours=int(hours), minutes=int(minutes), seconds=int(seconds or 0))
+      result = result + offset if sign == '+' else result - offset
+    return result
+
+  def log(self, message, **kwargs):
+    pass
+
+
+def interpret_condition(app, current_datetime, condition_set, triggers=None,
+                        evaluators=conditions.BASE_EVALUATORS,
+                        default_evaluator=conditions.evaluator_DEFAULT,
+                        operator=conditions.CONF_AND, **kwargs):
+  value = None
+  for condition in condition_set:
+    kind = condition[conditions.CONF_KIND]
+    for key in {k:v for (k, v) in condition.items()
+                if k != conditions.CONF_KIND}:
+      if key in (conditions.CONF_AND, conditions.CONF_OR):
+        intermediate_value = interpret_condition(
+            app, current_datetime, condition[key], triggers,
+            evaluators, default_evaluator, key, **kwargs)
+      elif key == conditions.CONF_NOT:
+        intermediate_value = not interpret_condition(
+            app, current_datetime, condition[key], triggers,
+            evaluators, default_evaluator, operator, **kwargs)
+      else:
+        intermediate_value = evaluators.get(key, default_evaluator)(
+            app, current_datetime, key, condition[key], triggers,
+            evaluators, default_evaluator, operator, kind, **kwargs)
+
+      if value is None:
+        value = intermediate_value
+      elif operator == conditions.CONF_AND:
+        value &= intermediate_value
+      else:
+        value |= intermediate_value
+
+  if value is None:
+    value = True
+  return value
+
+
+def legacy_evaluator_DAY(app, current_datetime, key, condition, triggers,
+                         evaluators, default_evaluator, operator, kind,
+                         **kwargs):
+  current_day = current_datetime.strftime('%a').lower()
+  if type(condition) == list:
+    return current_day in condition
+  return current_day == condition
+
+
+def generate_condition(depth, width, entities, rng=None):
+  """Generate a raw (unvalidated) condition set.
+
+  Each level has width members: one leaf, then nested and/or/not sets
+  (cycling per level) down to depth. Leaves are a mix of state, numeric,
+  trigger, time and day conditions over the given number of entities."""
+  rng = rng or random.Random(0)
+
+  def leaf():
+    entity = ENTITY_FORMAT % rng.randrange(entities)
+    choice = rng.random()
+    if choice < 0.1:
+      return {conditions.CONF_AFTER: rng.choice(
+          ['07:00:00', '22:30:00', 'sunset + 00:30'])}
+    elif choice < 0.2:
+      return {conditions.CONF_BETWEEN: rng.choice(
+          ['06:00:00 -> 09:00:00', '22:00:00 -> sunrise'])}
+    elif choice < 0.3:
+      return {conditions.CONF_DAY: rng.sample(conditions.VALID_DAYS, 3)}
+    elif choice < 0.5:
+      return {entity: rng.choice(['<=40', '>10', '>=5.5'])}
+    elif choice < 0.6:
+      return {entity: 'on',
+              conditions.CONF_KIND: conditions.CONF_KIND_TRIGGER}
+    return {entity: rng.choice(['on', 'off', '*'])}
+
+  def level(remaining):
+    if remaining == 0:
+      return [leaf() for _ in range(width)]
+    operator = (conditions.CONF_AND, conditions.CONF_OR,
+                conditions.CONF_NOT)[remaining % 3]
+    return [leaf()] + [
+        {operator: level(remaining - 1)} for _ in range(width - 1)]
+
+  return level(depth)
+
+
+def measure_allocations(func, number):
+  """Return (peak, retained) bytes allocated over number calls of func."""
+  tracemalloc.start()
+  try:
+    baseline = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    for _ in range(number):
+      func()
+    # Do not count cyclic garbage that is merely awaiting collection.
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return peak - baseline, current - baseline
+
+
+def run_benchmark(name, func, number):
+  secs = timeit.timeit(func, number=number)
+  peak, retained = measure_allocations(func, min(number, 1000))
+  print('  %-34s %12.0f ops/sec  peak %8i B  retained %8i B' % (
+      name, number / secs, peak, retained))
+  return secs
+
+
+def main(depth=4, width=3, entities=8, number=2000, seed=0):
+  rng = random.Random(seed)
+  app = FakeApp({ENTITY_FORMAT % i: rng.choice(STATE_VALUES)
+                 for i in range(entities)})
+  now = app.datetime()
+  triggers = {ENTITY_FORMAT % 0: 'on'}
+  condition_set = CONDITION_SCHEMA(
+      generate_condition(depth, width, entities, rng))
+
+  compiled = conditions.compile_condition(condition_set)
+  reordered = conditions.compile_condition(condition_set, reorder=True)
+
+  expected = bool(interpret_condition(app, now, condition_set, triggers))
+  assert bool(compiled(app, now, triggers)) == expected
+  assert bool(reordered(app, now, triggers)) == expected
+
+  print('depth=%i width=%i entities=%i number=%i seed=%i' % (
+      depth, width, entities, number, seed))
+  interpreted_secs = run_benchmark(
+      'interpreted',
+      lambda: interpret_condition(app, now, condition_set, triggers),
+      number)
+  run_benchmark(
+      'evaluate_condition',
+      lambda: conditions.evaluate_condition(
+          app, now, condition_set, triggers=triggers),
+      number)
+  compiled_secs = run_benchmark(
+      'compiled',
+      lambda: compiled(app, now, triggers),
+      number)
+  run_benchmark(
+      'compiled+reorder',
+      lambda: reordered(app, now, triggers),
+      number)
+  run_benchmark(
+      'compiled+reorder+snapshot',
+      lambda: reordered(app, now, triggers,
+                        snapshot=conditions.StateSnapshot(app)),
+      number)
+  run_benchmark(
+      'extract_entities_from_condition',
+      lambda: conditions.extract_entities_from_condition(condition_set),
+      number)
+  run_benchmark(
+      'build_entity_index',
+      lambda: conditions.build_entity_index(condition_set),
+      number)
+  print('  compiled speedup over interpreted: %.2fx' % (
+      interpreted_secs / compiled_secs))
+
+
+def main_day(number=100000):
+  days = ['mon', 'wed', 'fri', 'sun']
+  mask = CONDITION_SCHEMA([{conditions.CONF_DAY: days}])[0][
+      conditions.CONF_DAY]
+  now = datetime.datetime.now()
+  args = (None, now, conditions.CONF_DAY)
+  rest = (None, None, None, conditions.CONF_AND, conditions.CONF_KIND_STATE)
+
+  assert (conditions.evaluator_DAY(*args, mask, *rest) ==
+          legacy_evaluator_DAY(*args, days, *rest))
+
+  print('day (%s)' % mask)
+  legacy_secs = run_benchmark(
+      'strftime',
+      lambda: legacy_evaluator_DAY(*args, days, *rest), number)
+  mask_secs = run_benchmark(
+      'bitmask',
+      lambda: conditions.evaluator_DAY(*args, mask, *rest), number)
+  print('  bitmask speedup over strftime: %.2fx' % (legacy_secs / mask_secs))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--depth', type=int, default=4)
+  parser.add_argument('--width', type=int, default=3)
+  parser.add_argument('--entities', type=int, default=8)
+  parser.add_argument('--number', type=int, default=2000)
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  main(depth=args.depth, width=args.width, entities=args.entities,
+       number=args.number, seed=args.seed)
+  main_day(number=args.number * 50)
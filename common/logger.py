@@ -0,0 +1,54 @@
+"""Levelled, lazily formatted logging for the apps.
+
+Messages take %-style arguments, which are only formatted if the message is
+at or above the verbosity configured for the app, e.g.:
+
+  self._logger = logger.Logger(self, self._config.get(logger.CONF_VERBOSITY))
+  self._logger.debug('Activating output: %s', output)
+"""
+
+import voluptuous as vol
+
+CONF_VERBOSITY = 'verbosity'
+
+VERBOSITY_DEBUG = 'debug'
+VERBOSITY_INFO = 'info'
+VERBOSITY_WARNING = 'warning'
+
+LEVEL_DEBUG = 10
+LEVEL_INFO = 20
+LEVEL_WARNING = 30
+
+VERBOSITY_LEVELS = {
+  VERBOSITY_DEBUG: LEVEL_DEBUG,
+  VERBOSITY_INFO: LEVEL_INFO,
+  VERBOSITY_WARNING: LEVEL_WARNING,
+}
+
+DEFAULT_VERBOSITY = VERBOSITY_INFO
+
+CONFIG_VERBOSITY_SCHEMA = vol.All(vol.Lower, vol.In(VERBOSITY_LEVELS))
+
+class Logger(object):
+  """Wraps app.log(), filtering by level before any formatting is done.
+
+  Verbosity is per-app, and independent of the AppDaemon log level: debug
+  and info messages are both passed through at INFO if enabled."""
+  def __init__(self, app, verbosity=DEFAULT_VERBOSITY):
+    self._app = app
+    self._level = VERBOSITY_LEVELS[
+        CONFIG_VERBOSITY_SCHEMA(verbosity or DEFAULT_VERBOSITY)]
+
+  def is_enabled_for(self, level):
+    return level >= self._level
+
+  def debug(self, message, *args):
+    if LEVEL_DEBUG >= self._level:
+      self._app.log(message % args if args else message)
+
+  def info(self, message, *args):
+    if LEVEL_INFO >= self._level:
+      self._app.log(message % args if args else message)
+
+  def warning(self, message, *args):
+    self._app.log(message % args if args else message, level='WARNING')
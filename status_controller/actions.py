@@ -5,6 +5,7 @@ import time
 import threading
 
 import config as scc
+import logger
 
 # Expected workflow:
 #
@@ -13,6 +14,13 @@ import config as scc
 # - action.action()
 #
 # action.is_finished() will be True when action is complete.
+#
+# When the controller runs on the AppDaemon event loop (async mode), the
+# coroutines action.async_prepare() and action.async_action() are awaited
+# instead. By default they run the blocking variants on the AppDaemon
+# executor. Actions whose steps are only service calls await those calls
+# directly, since AppDaemon API calls made on the event loop return
+# awaitables.
 
 # A note on file format: For some unknown reason, if the media file is .wav
 # format (vs mp3), there will be a stutter on play to a joined group (perhaps
@@ -28,12 +36,24 @@ SONOS_SERVICE_VOLUME_SET = 'media_player/volume_set'
 SONOS_SERVICE_MEDIA_PLAY = 'media_player/play_media'
 SONOS_SERVICE_MEDIA_STOP = 'media_player/media_stop'
 
+SONOS_DOMAIN = 'media_player'
+SONOS_ATTR_GROUP = 'sonos_group'
+SONOS_ATTR_VOLUME = 'volume_level'
+# Players in these states have nothing (e.g. paused media) to restore.
+SONOS_IDLE_STATES = ('idle', 'off')
+
+# Light services take a list of entity_ids, so that entities sharing the same
+# arguments are turned on/off (or restored) with a single call.
+LIGHT_SERVICE_TURN_ON = 'homeassistant/turn_on'
+LIGHT_SERVICE_TURN_OFF = 'homeassistant/turn_off'
+
 class ActionBase(object):
-  def __init__(self, app, complete_callback, **kwargs):
+  def __init__(self, app, complete_callback, log=None, **kwargs):
     # kill_action() may be called from a different thread.
     self._lock = threading.RLock()
 
     self._app = app
+    self._log = log or logger.Logger(app)
     self._complete_callback = complete_callback
     self._kwargs = kwargs
     self._is_finished = False
@@ -51,6 +71,17 @@ class ActionBase(object):
     """Do the action that will visible to the user."""
     pass
 
+  async def async_prepare(self):
+    """Asynchronous prepare(), run on the AppDaemon event loop."""
+    if type(self).prepare is ActionBase.prepare:
+      # Nothing to prepare, so no need to wait on an executor thread.
+      return
+    await self._app.run_in_executor(self.prepare)
+
+  async def async_action(self):
+    """Asynchronous action(), run on the AppDaemon event loop."""
+    await self._app.run_in_executor(self.action)
+
   def complete_action(self, hard_kill_entities=None):
     """Complete any post-action steps."""
     with self._lock:
@@ -105,12 +136,38 @@ class SonosAction(TimedActionBase):
     self._primary = primary
     self._volume = self._pop_argument(scc.CONF_SONOS_VOLUME)
 
-    scc.log(self._app, self, 'Sonos entity: %s (Primary is: %s)' % (
-        self._entity_id, self._primary))
+    # The actions for every entity in this group (including this one), and
+    # the state of the players (see get_players_state()) when it was created.
+    self._group = [self]
+    self._players = {}
+
+    scc.log(self._log, self, 'Sonos entity: %s (Primary is: %s)',
+            self._entity_id, self._primary)
 
   def _is_primary(self):
     return self._entity_id == self._primary
 
+  def set_group(self, group, players=None):
+    """Set the actions for every entity in the group, which are prepared
+    together by the primary, and the current state of the players."""
+    self._group = group
+    self._players = players or {}
+
+  def _get_player_attribute(self, entity_id, attribute):
+    return self._players.get(entity_id, {}).get('attributes', {}).get(
+        attribute)
+
+  def needs_snapshot(self):
+    """Whether preparing and playing on this group changes anything that
+    needs restoring: the group topology or volumes, or the media (e.g. playing
+    or paused) of any player that is not idle."""
+    if not self._is_primary():
+      return False
+    return bool(self._get_prepare_service_calls()) or any(
+        self._players.get(action._entity_id, {}).get('state') not in
+            SONOS_IDLE_STATES
+        for action in self._group)
+
   def complete_action(self, hard_kill_entities=None):
     with self._lock:
       if self._is_finished:
@@ -124,68 +181,103 @@ class SonosAction(TimedActionBase):
 
   def prepare(self):
     super().prepare()
+    for service, kwargs in self._get_prepare_service_calls():
+      with self._lock:
+        if self._is_finished:
+          return
+      scc.log(self._log, self, 'Calling %s: %s', service, kwargs)
+      self._app.call_service(service, **kwargs)
 
-    self._unjoin()
-
-    # Primary does not need to join itself.
+  async def async_prepare(self):
+    # As prepare(), awaiting each service call in turn.
+    for service, kwargs in self._get_prepare_service_calls():
+      with self._lock:
+        if self._is_finished:
+          return
+      scc.log(self._log, self, 'Calling %s: %s', service, kwargs)
+      await self._app.call_service(service, **kwargs)
+
+  def _get_prepare_service_calls(self):
+    """Return the (service, kwargs) calls that prepare the group.
+
+    The primary issues only the calls needed to move from the current
+    topology (the sonos_group attribute of each player, the coordinator
+    first) to the group with itself as coordinator: an unjoin of itself if it
+    is grouped elsewhere or with other players, a single join of those not
+    yet in its group, and a volume call per distinct volume that differs. If
+    the topology is unknown, every entity is unjoined and rejoined. The other
+    entities have nothing to prepare."""
     if not self._is_primary():
-      self._join()
+      return []
+
+    entity_ids = [
+        action._entity_id for action in self._group
+        if not action.is_finished()]
+    calls = []
+
+    current_groups = [
+        self._get_player_attribute(entity_id, SONOS_ATTR_GROUP)
+        for entity_id in entity_ids]
+    primary_group = self._get_player_attribute(self._primary, SONOS_ATTR_GROUP)
+    if not all(current_groups) or not primary_group:
+      calls.append((SONOS_SERVICE_UNJOIN, {'entity_id': entity_ids}))
+      primary_group = [self._primary]
+    elif (primary_group[0] != self._primary or
+          not set(primary_group).issubset(entity_ids)):
+      calls.append((SONOS_SERVICE_UNJOIN, {'entity_id': [self._primary]}))
+      primary_group = [self._primary]
+
+    joining_entity_ids = [
+        entity_id for entity_id in entity_ids
+        if entity_id not in primary_group]
+    if joining_entity_ids:
+      calls.append((SONOS_SERVICE_JOIN, {
+          'master': self._primary, 'entity_id': joining_entity_ids}))
+
+    volumes = {}
+    for action in self._group:
+      if (action._volume and action._entity_id in entity_ids and
+          action._volume != self._get_player_attribute(
+              action._entity_id, SONOS_ATTR_VOLUME)):
+        volumes.setdefault(action._volume, []).append(action._entity_id)
+    for volume, volume_entity_ids in volumes.items():
+      calls.append((SONOS_SERVICE_VOLUME_SET, {
+          'entity_id': volume_entity_ids, 'volume_level': volume}))
+    return calls
+
+  @classmethod
+  def get_players_state(cls, app):
+    """Return the full state of every media player keyed by entity_id, from
+    a single read of the HA state."""
+    return app.get_state(SONOS_DOMAIN) or {}
 
-    self._set_volume()
+  @classmethod
+  def get_sonos_entity_ids(cls, players):
+    """Return the entity_ids of the Sonos players in players (see
+    get_players_state())."""
+    return sorted(
+        entity_id for entity_id, state in players.items()
+        if SONOS_ATTR_GROUP in (state or {}).get('attributes', {}))
 
   @classmethod
-  def capture_global_sonos_state(cls, app):
-    scc.log(app, cls, 'Saving global snapshot')
-    app.call_service(SONOS_SERVICE_SNAPSHOT, entity_id='all')
+  def capture_global_sonos_state(cls, app, log, entity_ids='all'):
+    scc.log(log, cls, 'Saving global snapshot: %s', entity_ids)
+    app.call_service(SONOS_SERVICE_SNAPSHOT, entity_id=entity_ids)
 
   @classmethod
-  def restore_global_sonos_state(cls, app):
-    scc.log(app, cls, 'Restoring global snapshot')
-    app.call_service(SONOS_SERVICE_RESTORE, entity_id='all')
+  def restore_global_sonos_state(cls, app, log, entity_ids='all'):
+    scc.log(log, cls, 'Restoring global snapshot: %s', entity_ids)
+    app.call_service(SONOS_SERVICE_RESTORE, entity_id=entity_ids)
 
   def _stop_media(self):
     with self._lock:
       if self._is_finished:
         return
-    scc.log(self._app, self, 'Stopping play on: %s' % self._entity_id)
+    scc.log(self._log, self, 'Stopping play on: %s', self._entity_id)
     self._app.call_service(
         SONOS_SERVICE_MEDIA_STOP,
         entity_id=self._entity_id)
 
-  def _set_volume(self):
-    if self._volume:
-      with self._lock:
-        if self._is_finished:
-          return
-      scc.log(self._app, self, 'Setting volume to %f for: %s' % (
-          self._volume, self._entity_id))
-      self._app.call_service(
-          SONOS_SERVICE_VOLUME_SET,
-          entity_id=self._entity_id,
-          volume_level=self._volume)
-
-  def _unjoin(self):
-    with self._lock:
-      if self._is_finished:
-        return
-    # Need to unjoin even if there's only 1 entity (as it may already be joined
-    # to something else, we do not know).
-    scc.log(self._app, self, 'Unjoining: %s' % self._entity_id)
-    self._app.call_service(
-        SONOS_SERVICE_UNJOIN,
-        entity_id=self._entity_id)
-
-  def _join(self):
-    with self._lock:
-      if self._is_finished:
-        return
-    scc.log(self._app, self, 'Joining \'%s\' to: %s' %
-        (self._entity_id, self._primary))
-    self._app.call_service(
-        SONOS_SERVICE_JOIN,
-        master=self._primary,
-        entity_id=self._entity_id)
-
 class SonosTTSAction(SonosAction):
   def __init__(self, app, complete_callback, entity_id, primary, **kwargs):
     super().__init__(app, complete_callback, entity_id, primary, **kwargs)
@@ -221,8 +313,8 @@ class SonosTTSAction(SonosAction):
       if self._is_finished:
         return
 
-    scc.log(self._app, self, 'Chiming on %s: \'%s\'' % (
-        self._entity_id, self._chime))
+    scc.log(self._log, self, 'Chiming on %s: \'%s\'',
+            self._entity_id, self._chime)
     self._app.call_service(
         SONOS_SERVICE_MEDIA_PLAY,
         entity_id=self._entity_id,
@@ -239,8 +331,8 @@ class SonosTTSAction(SonosAction):
     with self._lock:
       if self._is_finished:
         return
-    scc.log(self._app, self, 'Speaking on %s: \'%s\'' % (
-        self._entity_id, self._message))
+    scc.log(self._log, self, 'Speaking on %s: \'%s\'',
+            self._entity_id, self._message)
     self._app.call_service(
         self._tts_service,
         entity_id=self._entity_id,
@@ -262,8 +354,8 @@ class SonosPlayMediaAction(SonosAction):
       if self._is_finished:
         return
 
-    scc.log(self._app, self, 'Playing media on %s: \'%s\'' % (
-        self._entity_id, self._media))
+    scc.log(self._log, self, 'Playing media on %s: \'%s\'',
+            self._entity_id, self._media)
     self._app.call_service(
         SONOS_SERVICE_MEDIA_PLAY,
         entity_id=self._entity_id,
@@ -275,7 +367,7 @@ class SonosPlayMediaAction(SonosAction):
 
 class LightActionBase(TimedActionBase):
   def __init__(self, app, complete_callback, entity_id,
-               prior_state=None, **kwargs):
+               prior_state=None, current_state=None, **kwargs):
     super().__init__(app, complete_callback, **kwargs)
     self._finish_action = self._pop_argument(scc.CONF_FINISH_ACTION)
     self._entity_id = entity_id
@@ -284,6 +376,10 @@ class LightActionBase(TimedActionBase):
     # in the underlying entities, which may be different from the _entity_id.
     self._prior_state = prior_state
 
+    # The state ('on'/'off') of _entity_id, if captured by the controller,
+    # tracked locally as the action toggles it.
+    self._state = current_state
+
   def _sanitize_args(self, ref, **kwargs):
     output = {}
     for arg in kwargs:
@@ -291,36 +387,58 @@ class LightActionBase(TimedActionBase):
         output[arg] = kwargs[arg]
     return output
 
+  def _get_state(self):
+    if self._state is None:
+      self._state = self._app.get_state(self._entity_id)
+    return self._state
+
   def _toggle(self):
-    scc.log(self._app, self, 'Toggling: %s (%s)' % (
-        self._entity_id, self._kwargs))
-    if self._app.get_state(self._entity_id) == 'on':
+    scc.log(self._log, self, 'Toggling: %s (%s)',
+            self._entity_id, self._kwargs)
+    if self._get_state() == 'on':
       self._turn_off()
+      self._state = 'off'
     else:
       self._turn_on()
+      self._state = 'on'
+
+  def _get_toggle_service_call(self):
+    """As _toggle(), but return the (service, kwargs) to call (without the
+    entity_id) rather than calling it."""
+    if self._get_state() == 'on':
+      self._state = 'off'
+      return LIGHT_SERVICE_TURN_OFF, self._sanitize_args(
+          ref=scc.ARGS_FOR_TURN_OFF, **self._kwargs)
+    self._state = 'on'
+    return LIGHT_SERVICE_TURN_ON, self._sanitize_args(
+        ref=scc.ARGS_FOR_TURN_ON, **self._kwargs)
 
   def _turn_on_with_args(self, entity_id=None, **kwargs):
+    """Turn on entity_id, which may be a list of entity_ids."""
     with self._lock:
       if self._is_finished:
         return
 
     entity_id = entity_id or self._entity_id
     sanitized_args = self._sanitize_args(ref=scc.ARGS_FOR_TURN_ON, **kwargs)
-    scc.log(self._app, self, 'Turning on: %s (%s)' % (entity_id, sanitized_args))
-    self._app.turn_on(entity_id, **sanitized_args)
+    scc.log(self._log, self, 'Turning on: %s (%s)', entity_id, sanitized_args)
+    self._app.call_service(
+        LIGHT_SERVICE_TURN_ON, entity_id=entity_id, **sanitized_args)
 
   def _turn_on(self):
     return self._turn_on_with_args(**self._kwargs)
 
   def _turn_off_with_args(self, entity_id=None, **kwargs):
+    """Turn off entity_id, which may be a list of entity_ids."""
     with self._lock:
       if self._is_finished:
         return
 
     entity_id = entity_id or self._entity_id
     sanitized_args = self._sanitize_args(ref=scc.ARGS_FOR_TURN_OFF, **kwargs)
-    scc.log(self._app, self, 'Turning off: %s (%s)' % (entity_id, sanitized_args))
-    self._app.turn_off(entity_id, **sanitized_args)
+    scc.log(self._log, self, 'Turning off: %s (%s)', entity_id, sanitized_args)
+    self._app.call_service(
+        LIGHT_SERVICE_TURN_OFF, entity_id=entity_id, **sanitized_args)
 
   def _turn_off(self):
     return self._turn_off_with_args(**self._kwargs)
@@ -339,48 +457,69 @@ class LightActionBase(TimedActionBase):
         self._restore_state()
     else:
       with self._lock:
-        for entity_id in self._prior_state:
-          if entity_id in hard_kill_entities:
-            continue
+        entity_ids = [
+            entity_id for entity_id in self._prior_state
+            if entity_id not in hard_kill_entities]
+        if entity_ids:
           if self._finish_action == scc.CONF_ACTION_LIGHT_TURN_ON:
-            self._turn_on_with_args(entity_id=entity_id, **self._kwargs)
+            self._turn_on_with_args(entity_id=entity_ids, **self._kwargs)
           elif self._finish_action == scc.CONF_ACTION_LIGHT_TURN_OFF:
-            self._turn_off_with_args(entity_id=entity_id, **self._kwargs)
+            self._turn_off_with_args(entity_id=entity_ids, **self._kwargs)
           elif self._finish_action == scc.CONF_ACTION_LIGHT_RESTORE:
-            self._restore_state(entity_id=entity_id)
+            self._restore_state(entity_ids=entity_ids)
     super().complete_action(hard_kill_entities=hard_kill_entities)
 
-  def _restore_state(self, entity_id=None):
+  def _restore_state(self, entity_ids=None):
     with self._lock:
       state = self._prior_state
       if not state:
         return
 
-    if entity_id is not None:
-      entities = [entity_id]
-      scc.log(self._app, self, 'Reduced restore for %s' % entity_id)
+    if entity_ids is not None:
+      scc.log(self._log, self, 'Reduced restore for %s', entity_ids)
     else:
-      entities = state.keys()
-
-    for entity_id in entities:
-      scc.log(self._app, self, 'Restoring state for: %s (%s)' % (entity_id, state[entity_id]))
+      entity_ids = state.keys()
+
+    # Restore entities with the same state and attributes with a single call.
+    buckets = {}
+    for entity_id in entity_ids:
+      scc.log(self._log, self, 'Restoring state for: %s (%s)',
+              entity_id, state[entity_id])
+      if not state[entity_id]:
+        continue
       if state[entity_id].get(scc.KEY_STATE) == 'on':
-        self._turn_on_with_args(
-            entity_id=entity_id,
-            **self._sanitize_args(
-                ref=scc.ATTR_ARGS_FOR_TURN_ON,
-                **state[entity_id].get(scc.KEY_ATTRIBUTES)))
+        args = self._sanitize_args(
+            ref=scc.ATTR_ARGS_FOR_TURN_ON,
+            **state[entity_id].get(scc.KEY_ATTRIBUTES))
       elif state[entity_id].get(scc.KEY_STATE) == 'off':
-        self._turn_off_with_args(
-            entity_id=entity_id,
+        args = self._sanitize_args(
+            ref=scc.ARGS_FOR_TURN_OFF,
             **state[entity_id].get(scc.KEY_ATTRIBUTES))
+      else:
+        continue
+      key = (state[entity_id].get(scc.KEY_STATE),
+             tuple(sorted((arg, repr(args[arg])) for arg in args)))
+      buckets.setdefault(key, (args, []))[1].append(entity_id)
+
+    for (entity_state, _), (args, bucket_entity_ids) in buckets.items():
+      if entity_state == 'on':
+        self._turn_on_with_args(entity_id=bucket_entity_ids, **args)
+      else:
+        self._turn_off_with_args(entity_id=bucket_entity_ids, **args)
 
   @classmethod
-  def capture_state(cls, app, entity_id):
-    prior_state = app.get_state(entity_id, attribute='all')
-    scc.log(app, cls, 'Capturing state from \'%s\': %s' % (
-        entity_id, prior_state))
-    return prior_state
+  def capture_states(cls, app, entity_ids, log):
+    """Return the full state of each of entity_ids, reading the states of
+    each domain involved at once (rather than each entity)."""
+    domains = {entity_id.split('.', 1)[0] for entity_id in entity_ids}
+    states = {}
+    for domain in domains:
+      states.update(app.get_state(domain) or {})
+
+    prior_states = {
+        entity_id: states.get(entity_id) for entity_id in entity_ids}
+    scc.log(log, cls, 'Capturing state of %i entities', len(prior_states))
+    return prior_states
 
 
 class SimpleLightAction(LightActionBase):
@@ -396,10 +535,75 @@ class SimpleLightAction(LightActionBase):
     self._schedule_action_complete()
 
 
+class BreathingScheduler(object):
+  """Beats every active BreathingLightAction from a single timer per beat
+  length, so that they breathe in phase.
+
+  The actions track their on/off state locally, and on each beat the
+  toggles of all actions are made with a call per distinct service and
+  arguments."""
+  def __init__(self, app, log=None):
+    self._app = app
+    self._log = log or logger.Logger(app)
+    self._lock = threading.Lock()
+    # beat_length -> timer handle / list of actions.
+    self._timer_handles = {}
+    self._actions = {}
+
+  def add(self, action, beat_length):
+    """Beat action from the next beat (immediately, if it is the only
+    action with its beat length)."""
+    with self._lock:
+      self._actions.setdefault(beat_length, []).append(action)
+      if beat_length not in self._timer_handles:
+        self._timer_handles[beat_length] = self._app.run_every(
+            self._beat, 'now', beat_length, beat_length=beat_length)
+
+  def remove(self, action, beat_length):
+    with self._lock:
+      beat_actions = self._actions.get(beat_length, [])
+      if action in beat_actions:
+        beat_actions.remove(action)
+      if not beat_actions and beat_length in self._timer_handles:
+        self._app.cancel_timer(self._timer_handles.pop(beat_length))
+        del self._actions[beat_length]
+
+  def _beat(self, kwargs):
+    with self._lock:
+      beat_actions = list(self._actions.get(kwargs['beat_length'], []))
+
+    # (service, arguments key) -> (service, arguments, [action, ...])
+    calls = {}
+    for action in beat_actions:
+      service_call = action.beat()
+      if service_call is None:
+        continue
+      service, arguments = service_call
+      key = (service, tuple(sorted(
+          (argument, repr(arguments[argument])) for argument in arguments)))
+      calls.setdefault(key, (service, arguments, []))[2].append(action)
+
+    for service, arguments, call_actions in calls.values():
+      # Skip any actions that were completed (e.g. killed) in the meantime.
+      entity_ids = [
+          action.get_entity_id() for action in call_actions
+          if not action.is_finished()]
+      if entity_ids:
+        scc.log(self._log, self, 'Breathing %s: %s (%s)',
+                service, entity_ids, arguments)
+        self._app.call_service(service, entity_id=entity_ids, **arguments)
+
+
 class BreathingLightAction(LightActionBase):
   def __init__(self, app, complete_callback, entity_id,
-               prior_state=None, **kwargs):
-    super().__init__(app, complete_callback, entity_id, prior_state, **kwargs)
+               prior_state=None, current_state=None, scheduler=None,
+               **kwargs):
+    super().__init__(app, complete_callback, entity_id, prior_state,
+                     current_state, **kwargs)
+
+    # Without a scheduler shared with other actions, this action beats on its
+    # own timer.
+    self._scheduler = scheduler or BreathingScheduler(app, self._log)
 
     self._beats_remaining = None
 
@@ -411,10 +615,11 @@ class BreathingLightAction(LightActionBase):
 
     # If it's on, give it an extra beat to toggle to off first, before
     # starting the right number of breathes.
-    if self._app.get_state(entity_id) == 'on':
+    if self._get_state() == 'on':
       self._beats_remaining += 1
 
-    self._breathe_timer_handle = None
+  def get_entity_id(self):
+    return self._entity_id
 
   def action(self):
     super().action()
@@ -422,34 +627,26 @@ class BreathingLightAction(LightActionBase):
       if self._is_finished:
         return
 
-    self._breathe_timer_handle = self._app.run_every(
-        self._breathe,
-        'now',
-        self._beat_length, **{})
+    self._scheduler.add(self, self._beat_length)
 
   def complete_action(self, hard_kill_entities=None):
     with self._lock:
       if self._is_finished:
         return
-      self._cancel_breathe_timer()
+    self._scheduler.remove(self, self._beat_length)
     super().complete_action(hard_kill_entities=hard_kill_entities)
 
-  def _cancel_breathe_timer(self):
-    with self._lock:
-      if self._breathe_timer_handle is not None:
-        self._cancel_timer(self._breathe_timer_handle)
-        self._breathe_timer_handle = None
-
-  def _breathe(self, kwargs):
+  def beat(self):
+    """Called by the scheduler on each beat. Returns the (service, kwargs)
+    call that toggles the entity, or None."""
     with self._lock:
       if self._is_finished:
-        return
+        return None
     if self._beats_remaining <= 0:
-      self._cancel_breathe_timer()
       self.complete_action()
-    else:
-      self._toggle()
-      self._beats_remaining -= 1
+      return None
+    self._beats_remaining -= 1
+    return self._get_toggle_service_call()
 
 
 class ServiceAction(ActionBase):
@@ -457,8 +654,29 @@ class ServiceAction(ActionBase):
     super().__init__(app, complete_callback, **kwargs)
 
   def _call_service(self, service, **kwargs):
-    scc.log(self._app, self, 'Calling: %s (%s)' % (service, kwargs))
-    self._app.call_service(service, **kwargs)
+    scc.log(self._log, self, 'Calling: %s (%s)', service, kwargs)
+    return self._app.call_service(service, **kwargs)
+
+  def _get_service_call(self):
+    """Return the (service, kwargs) to call, or None."""
+    return None
+
+  def action(self):
+    super().action()
+    with self._lock:
+      if self._is_finished:
+        return
+    service_call = self._get_service_call()
+    if service_call:
+      self._call_service(service_call[0], **service_call[1])
+
+  async def async_action(self):
+    with self._lock:
+      if self._is_finished:
+        return
+    service_call = self._get_service_call()
+    if service_call:
+      await self._call_service(service_call[0], **service_call[1])
 
 
 class NotifyAction(ServiceAction):
@@ -467,12 +685,8 @@ class NotifyAction(ServiceAction):
 
     self._notify_service = self._pop_argument(scc.CONF_SERVICE)
 
-  def action(self):
-    super().action()
-    with self._lock:
-      if self._is_finished:
-        return
-    self._call_service(self._notify_service, **self._kwargs)
+  def _get_service_call(self):
+    return (self._notify_service, self._kwargs)
 
 class MQTTAction(ServiceAction):
   def __init__(self, app, complete_callback, **kwargs):
@@ -482,14 +696,10 @@ class MQTTAction(ServiceAction):
     self._topic = self._pop_argument(scc.CONF_ACTION_MQTT_TOPIC)
     self._payload = self._pop_argument(scc.CONF_ACTION_MQTT_PAYLOAD)
 
-  def action(self):
-    super().action()
-    with self._lock:
-      if self._is_finished:
-        return
+  def _get_service_call(self):
     kwargs = { scc.CONF_ACTION_MQTT_TOPIC: self._topic,
                scc.CONF_ACTION_MQTT_PAYLOAD: self._payload }
-    self._call_service(self._notify_service, **kwargs)
+    return (self._notify_service, kwargs)
 
 
 LIGHT_ACTION_MAP = {
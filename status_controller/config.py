@@ -4,6 +4,7 @@ import datetime
 import voluptuous as vol
 
 import conditions
+import logger
 
 KEY_STATE = 'state'
 KEY_ATTRIBUTES = 'attributes'
@@ -65,6 +66,10 @@ CONF_EVENT = 'event'
 CONF_ARGUMENTS = 'arguments'
 CONF_BREATH_LENGTH = 'breath_length'      # Length of a single breath.
 CONF_LENGTH = 'length'
+CONF_WORKERS = 'workers'                  # Size of the action worker pool.
+CONF_MODE = 'mode'
+CONF_MODE_THREAD = 'thread'
+CONF_MODE_ASYNC = 'async'
 
 CONF_ACTION = 'action'
 CONF_FINISH_ACTION = 'finish_action'
@@ -148,6 +153,9 @@ DEFAULT_SONOS_CHIME_LENGTH = 3
 DEFAULT_MQTT_SERVICE = 'mqtt/publish'
 DEFAULT_MQTT_PAYLOAD = '{{ tags|tojson }}'
 
+DEFAULT_WORKERS = 8
+DEFAULT_MODE = CONF_MODE_THREAD
+
 DEFAULT_FORCE = False
 MIN_PRIORITY = 0
 MAX_PRIORITY = 100
@@ -287,6 +295,14 @@ CONFIG_SCHEMA = vol.Schema({
   vol.Optional(CONF_OUTPUTS): vol.Schema([
     CONFIG_SCHEMA_OUTPUT
   ]),
+  vol.Optional(CONF_WORKERS, default=DEFAULT_WORKERS): vol.All(
+      int, vol.Range(min=1)),
+  # Run the controller in a thread (executing actions on a worker pool), or
+  # as tasks on the AppDaemon event loop.
+  vol.Optional(CONF_MODE, default=DEFAULT_MODE): vol.In(
+      [CONF_MODE_THREAD, CONF_MODE_ASYNC]),
+  vol.Optional(logger.CONF_VERBOSITY,
+               default=logger.DEFAULT_VERBOSITY): logger.CONFIG_VERBOSITY_SCHEMA,
 }, extra=vol.ALLOW_EXTRA)
 
 EVENT_SCHEMA = vol.Schema({
@@ -298,39 +314,47 @@ EVENT_SCHEMA = vol.Schema({
   vol.Optional(CONF_MQTT): CONFIG_SCHEMA_MQTT_ATTR,
 }, extra=vol.PREVENT_EXTRA)
 
-def get_event_arguments(config, event, output_args, domain):
-  args = {}
-
-  # Args in the event are the default.
-  if domain in event:
-    args = copy.copy(event.get(domain))
-
-  # Overwrite event args with tag args.
-  event_tags = event.get(CONF_TAGS)
-  tags = config.get(CONF_TAGS)
-  for event_tag in event_tags:
-    if tags and event_tag in tags:
-      if tags[event_tag] and domain in tags[event_tag]:
-        tag_args = tags[event_tag][domain]
-        for arg in tag_args:
-          args[arg] = tag_args[arg]
-
-  # Finally, overwrite with output entity args,
-  # which take absolute priority.
-  if output_args:
-    for arg in output_args:
-      args[arg] = output_args[arg]
-
-  # Populate some defaults if they are missing.
-  for key in DEFAULTS_MAPPING[domain]:
-    if key not in args:
-      args[key] = DEFAULTS_MAPPING[domain][key]
-
-  return args
-
-def log(app, obj, message):
+class EventArgumentResolver(object):
+  """Resolves the arguments for an output entry (of a domain) for an event.
+
+  In increasing order of priority, arguments come from: the domain defaults,
+  the event, the configuration of each of the event tags (later tags taking
+  priority) and finally the output entry itself. The tag layers are merged
+  once per distinct combination of tags, rather than on every call."""
+  def __init__(self, config):
+    tags = config.get(CONF_TAGS) or {}
+    self._tag_layers = {
+        domain: {
+            tag: tags[tag][domain]
+            for tag in tags if tags[tag] and domain in tags[tag]}
+        for domain in DEFAULTS_MAPPING}
+    self._merged_tag_layers = {}
+
+  def _get_tag_layer(self, event_tags, domain):
+    tag_layers = self._tag_layers[domain]
+    key = (domain, tuple(tag for tag in event_tags if tag in tag_layers))
+    if key not in self._merged_tag_layers:
+      merged = {}
+      for tag in key[1]:
+        merged.update(tag_layers[tag])
+      self._merged_tag_layers[key] = merged
+    return self._merged_tag_layers[key]
+
+  def resolve(self, event, output_args, domain):
+    return {
+        **DEFAULTS_MAPPING[domain],
+        **event.get(domain, {}),
+        **self._get_tag_layer(event.get(CONF_TAGS), domain),
+        **(output_args or {}),
+    }
+
+def log(app_logger, obj, message, *args):
+  """Log a debug message from obj (an action or action class) to app_logger
+  (a logger.Logger), which formats it only if debug messages are enabled."""
+  if not app_logger.is_enabled_for(logger.LEVEL_DEBUG):
+    return
   if type(obj) == type:
     name = obj.__name__
   else:
     name = type(obj).__name__
-  app.log('[%s]: %s' % (name, message))
+  app_logger.debug('[%s]: ' + message, name, *args)
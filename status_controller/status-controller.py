@@ -1,5 +1,11 @@
+import abc
+import asyncio
+import collections
 import copy
 import datetime
+import functools
+import heapq
+import itertools
 import logging
 import operator
 import os
@@ -11,17 +17,20 @@ import traceback
 import appdaemon.plugins.hass.hassapi as hass
 import voluptuous as vol
 
-import jinja2
-
 import config as scc
 import actions
 import conditions
+import logger
+import templates
+import workers
 
 # A note on restoring the state pre-event:
 #
 # Sonos: Sonos groups are snapshot globally to avoid corner cases in grouping
 # scenarios that may cause the wrong thing to be restored, and to avoid delay
 # in snapshoting/restoring if it were done before & after each entity level event.
+# The snapshot is skipped if there is nothing to restore, in which case any
+# later overlapping event snapshots every player but those still in use.
 #
 # Lights: State is captured centrally per entity, and restored in the action
 # objects themselves. This deals better with multiple events that change the
@@ -29,18 +38,37 @@ import conditions
 # when a series of events is finished.
 #
 
+# Domains of the per-output action entries.
+OUTPUT_DOMAINS = (scc.CONF_SONOS, scc.CONF_LIGHT, scc.CONF_NOTIFY, scc.CONF_MQTT)
+
+# Maximum number of distinct events for which matched outputs are cached.
+OUTPUT_CACHE_SIZE = 32
+
 class StatusControllerApp(hass.Hass):
   def initialize(self):
     config = scc.CONFIG_SCHEMA(self.args)
-    self._status_controller = StatusController(self, config)
-    self._status_controller.daemon = True
-    self._status_controller.start()
+    self._logger = logger.Logger(self, config.get(logger.CONF_VERBOSITY))
+    if config.get(scc.CONF_MODE) == scc.CONF_MODE_ASYNC:
+      self._status_controller = AsyncStatusController(self, config)
+      # Started from an async callback, so that it runs on the event loop.
+      self.run_in(self._start_async_controller, 0)
+    else:
+      self._status_controller = StatusController(self, config)
+      self._status_controller.daemon = True
+      self._status_controller.start()
     self.listen_event(
         self.handle_status_event,
         event=config.get(scc.CONF_EVENT_NAME))
 
+  def terminate(self):
+    self._status_controller.terminate()
+
+  async def _start_async_controller(self, kwargs):
+    self._status_controller_task = asyncio.get_running_loop().create_task(
+        self._status_controller.run())
+
   def handle_status_event(self, event_name, data, kwargs):
-    self.log('Received event: %s (%s)' % (event_name, data))
+    self._logger.debug('Received event: %s (%s)', event_name, data)
     event = scc.EVENT_SCHEMA(data)
     self._status_controller.add(event)
 
@@ -50,29 +78,79 @@ def evaluator_TAG(app, current_datetime, key, condition, triggers,
   return condition in kwargs['event'][scc.CONF_TAGS]
 
 
-class StatusController(threading.Thread):
-  def __init__(self, app, config, *args, **kwargs):
-    super().__init__(*args, **kwargs)
+class StatusControllerBase(abc.ABC):
+  """Event and action bookkeeping, shared by the threaded and async
+  controllers. These differ only in how the controller cycle is woken, and
+  how actions are executed."""
+  def __init__(self, app, config):
     self._app = app
     self._config = config
+    self._event_arguments = scc.EventArgumentResolver(config)
+    templates.warm_from_config(config)
+    self._logger = logger.Logger(app, config.get(logger.CONF_VERBOSITY))
     self._underlying_light_entities = config.get(
         scc.CONF_UNDERLYING_ENTITIES, {}).get(
         scc.CONF_LIGHT, {})
 
     self._cv = threading.Condition()
+    # Heap of (-priority, sequence, force, event, outputs): highest priority
+    # first, then first-in first-out.
     self._events = []
+    self._event_sequence = itertools.count()
 
-    # Entities that have an ongoing action.
+    # Contended events, parked against one of the entities they're waiting
+    # for. They're requeued when that entity's action is removed.
+    self._parked_events = {}
+
+    # Ongoing actions, indexed both ways: entity -> action, and action -> its
+    # entities.
     self._entity_to_action = {}
+    self._action_to_entities = {}
+    self._sonos_actions_in_flight = 0
+
+    # Actions that have reported completion, removed on the next cycle.
+    self._finished_actions = set()
 
-    # Capture state information.
-    self._captured_global_sonos_state = False
+    # Capture state information. The Sonos entity_ids ('all', or a list) that
+    # were snapshot, or None if there is no snapshot.
+    self._captured_sonos_entity_ids = None
     self._captured_light_state = {}
 
+    # Breathing light actions beat in phase from shared timers.
+    self._breathing_scheduler = actions.BreathingScheduler(
+        app, self._logger)
+
     self._output_evaluators = copy.copy(conditions.BASE_EVALUATORS)
     self._output_evaluators.update({
       scc.CONF_TAG: evaluator_TAG,
     })
+    self._output_costs = copy.copy(conditions.BASE_COSTS)
+    self._output_costs.update({
+      scc.CONF_TAG: conditions.COST_CHEAP,
+    })
+    self._compiled_output_conditions = conditions.compile_many(
+        [output.get(scc.CONF_CONDITION, [])
+         for output in config.get(scc.CONF_OUTPUTS, [])],
+        evaluators=self._output_evaluators,
+        reorder=True, costs=self._output_costs)
+
+    # Matched outputs (with their resolved arguments) only depend on the
+    # event if no output condition reads entity state, in which case they
+    # are cached until the next time boundary of those conditions.
+    self._output_extractors = copy.copy(conditions.BASE_EXTRACTORS)
+    self._output_extractors.update({
+      scc.CONF_TAG: conditions.extractor_NULL,
+    })
+    self._output_cache_enabled = not any(
+        conditions.extract_entities_from_condition(
+            output.get(scc.CONF_CONDITION, []),
+            extractors=self._output_extractors)
+        for output in config.get(scc.CONF_OUTPUTS, []))
+    self._output_cache = collections.OrderedDict()
+    self._output_condition_leaves = [
+        condition
+        for output in config.get(scc.CONF_OUTPUTS, [])
+        for condition in output.get(scc.CONF_CONDITION, [])]
 
   def _thread_wrap_for_appdaemon(self, func, *args, **kwargs):
     try:
@@ -83,17 +161,25 @@ class StatusController(threading.Thread):
       stack_trace = traceback.format_exc()
       self._app.error('%s%s%s' % (e, os.linesep, stack_trace), level="ERROR")
 
-  def run(self):
-    self._thread_wrap_for_appdaemon(self._run_controller_cycle)
-
   def _is_sonos_action(self, action):
     return isinstance(action, actions.SonosAction)
 
   def _is_sonos_action_in_flight(self):
-    for action in self._entity_to_action.values():
+    return self._sonos_actions_in_flight > 0
+
+  def _get_sonos_entities_in_flight(self):
+    return set(
+        entity for action, entities in self._action_to_entities.items()
+        if self._is_sonos_action(action) for entity in entities)
+
+  def _add_action(self, action, entities):
+    if action not in self._action_to_entities:
+      self._action_to_entities[action] = set()
       if self._is_sonos_action(action):
-        return True
-    return False
+        self._sonos_actions_in_flight += 1
+    self._action_to_entities[action].update(entities)
+    for entity in entities:
+      self._entity_to_action[entity] = action
 
   def _kill_actions_on_entities(self, entities):
     actions_to_kill = set()
@@ -105,194 +191,240 @@ class StatusController(threading.Thread):
     self._remove_actions(actions_to_kill)
 
   def _remove_actions(self, actions_to_remove):
-    for entity in [key for key in self._entity_to_action
-                   if self._entity_to_action[key] in actions_to_remove]:
-      del(self._entity_to_action[entity])
+    for action in actions_to_remove:
+      entities = self._action_to_entities.pop(action, None)
+      self._finished_actions.discard(action)
+      if entities is None:
+        continue
+      if self._is_sonos_action(action):
+        self._sonos_actions_in_flight -= 1
+      for entity in entities:
+        # The entity may since have been taken over by a newer action.
+        if self._entity_to_action.get(entity) is action:
+          del(self._entity_to_action[entity])
+          self._unpark_events(entity)
+
+  def _park_event(self, entity, event_tpl):
+    self._parked_events.setdefault(entity, []).append(event_tpl)
+
+  def _unpark_events(self, entity):
+    for event_tpl in self._parked_events.pop(entity, []):
+      heapq.heappush(self._events, event_tpl)
 
   def _remove_finished_actions(self):
-    finished_actions = set()
-    for entity in self._entity_to_action:
-      if self._entity_to_action[entity].is_finished():
-        finished_actions.add(self._entity_to_action[entity])
+    finished_actions = self._finished_actions
+    self._finished_actions = set()
     self._remove_actions(finished_actions)
 
-  def _run_controller_cycle(self):
-    with self._cv:
-      while True:
-        self._app.log('Starting controller cycle, waiting...')
-        self._cv.wait()
-        self._app.log('...controller woken')
-
-        # Clean up finished actions.
-        self._remove_finished_actions()
-
-        # Process new actions.
-        for event_tpl in sorted(
-            self._events,
-            reverse=True,
-            key = lambda x: x[0]):
-          # Process the whole available event list, and only then add the
-          # postponed events back (to avoid a high-priority event with a
-          # contended entity from preventing uncontended events from being
-          # processed.
-          priority, force, event, outputs = event_tpl
-
-          entities_in_outputs = self._get_entities_involved_in_outputs(outputs)
-          overlapping_entities = entities_in_outputs.intersection(
-              set(self._entity_to_action))
-
-          if overlapping_entities:
-            if force:
-              self._app.log(
-                  'Found contended event. Force killing '
-                  'actions using in-scope entities. Event: %s, '
-                  'overlapping entities: %s' % (event, overlapping_entities))
-              self._kill_actions_on_entities(entities_in_outputs)
-            else:
-              self._app.log('Found contended event. Postponing. Event: %s, '
-                  'overlapping entities: %s' % (event, overlapping_entities))
-              continue
-
-          self._events.remove(event_tpl)
-          self._process_single_event(event, outputs)
-
-        # If there's a captured Sonos state, and there's no Sonos action in
-        # flight (after new events have been added above), then it's time to
-        # restore the state.
-        if (self._captured_global_sonos_state and
-            not self._is_sonos_action_in_flight()):
-          actions.SonosAction.restore_global_sonos_state(self._app)
-          self._captured_global_sonos_state = False
-
-        # If there's a captured light state, and there's no light action for
-        # that entity in flight (after new events have been added above), then
-        # it's time to remove that saved state. It will be recaptured when
-        # needed.
-        for entity_id in [key for key in self._captured_light_state
-                          if key not in self._entity_to_action]:
-          self._app.log('Deleting state for %s' % entity_id)
-          del(self._captured_light_state[entity_id])
-
+  def _run_cycle(self):
+    # Clean up finished actions.
+    self._remove_finished_actions()
+
+    # Process new actions. Contended events are parked (rather than
+    # blocking the queue), so that a high-priority event with a contended
+    # entity does not prevent uncontended events from being processed.
+    while self._events:
+      event_tpl = heapq.heappop(self._events)
+      _, _, force, event, outputs = event_tpl
+
+      entities_in_outputs = self._get_entities_involved_in_outputs(outputs)
+      overlapping_entities = set(
+          entity for entity in entities_in_outputs
+          if entity in self._entity_to_action)
+
+      if overlapping_entities:
+        if force:
+          self._logger.info(
+              'Found contended event. Force killing '
+              'actions using in-scope entities. Event: %s, '
+              'overlapping entities: %s', event, overlapping_entities)
+          self._kill_actions_on_entities(entities_in_outputs)
+        else:
+          self._logger.info('Found contended event. Postponing. Event: %s, '
+              'overlapping entities: %s', event, overlapping_entities)
+          self._park_event(next(iter(overlapping_entities)), event_tpl)
+          continue
 
-  def add(self, event):
+      self._process_single_event(event, outputs)
+
+    # If there's a captured Sonos state, and there's no Sonos action in
+    # flight (after new events have been added above), then it's time to
+    # restore the state.
+    if (self._captured_sonos_entity_ids is not None and
+        not self._is_sonos_action_in_flight()):
+      actions.SonosAction.restore_global_sonos_state(
+          self._app, self._logger, self._captured_sonos_entity_ids)
+      self._captured_sonos_entity_ids = None
+
+    # If there's a captured light state, and there's no light action for
+    # that entity in flight (after new events have been added above), then
+    # it's time to remove that saved state. It will be recaptured when
+    # needed.
+    for entity_id in [key for key in self._captured_light_state
+                      if key not in self._entity_to_action]:
+      self._logger.debug('Deleting state for %s', entity_id)
+      del(self._captured_light_state[entity_id])
+
+  def _get_event_tuple(self, event):
+    """Return the queue entry for an event, or None if it has nothing to
+    do."""
     priorities = set()
     force = False
 
     # Take the highest output priority, and use that as the event priority.
-    outputs = self._get_matching_outputs(event)
+    outputs = self._get_resolved_outputs(event)
     for output in outputs:
-      settings = scc.get_event_arguments(
-          self._config,
-          event,
-          output.get(scc.CONF_SETTINGS, None),
-          scc.CONF_SETTINGS)
-      if settings[scc.CONF_FORCE]:
+      if output[scc.CONF_SETTINGS][scc.CONF_FORCE]:
         force = True
 
-      for domain in (scc.CONF_SONOS, scc.CONF_LIGHT,
-          scc.CONF_NOTIFY, scc.CONF_MQTT):
-        if not domain in output:
-          continue
+      for domain in OUTPUT_DOMAINS:
         for entry in output[domain]:
-          entry = scc.get_event_arguments(self._config, event, entry, domain)
           priorities.add(entry[scc.CONF_PRIORITY])
 
-    if priorities:
-      with self._cv:
-        self._events.append((max(priorities), force, event, outputs))
-        self._cv.notify()
+    if not priorities:
+      return None
+    return (-max(priorities), next(self._event_sequence), force, event,
+            outputs)
 
-  def _report_action_finished(self, action):
-    with self._cv:
-      self._cv.notify()
+  def _get_output_cache_key(self, event):
+    # Tag order is significant, as later tags override earlier ones.
+    try:
+      return (tuple(event[scc.CONF_TAGS]), frozenset(
+          (domain, frozenset(event[domain].items()))
+          for domain in event if domain != scc.CONF_TAGS))
+    except TypeError:
+      # Unhashable override values (e.g. an rgb_color list) are not cached.
+      return None
+
+  def _get_resolved_outputs(self, event) -> list:
+    """Return the arguments for each output matching the event.
+
+    Each output is a dict with the resolved settings, and a list of resolved
+    arguments per domain. These are shared between events, and must not be
+    modified."""
+    key = None
+    if self._output_cache_enabled:
+      key = self._get_output_cache_key(event)
+    current_datetime = self._app.datetime()
+
+    if key is not None and key in self._output_cache:
+      expiry, outputs = self._output_cache[key]
+      if expiry is None or current_datetime < expiry:
+        self._output_cache.move_to_end(key)
+        return outputs
+      del(self._output_cache[key])
+
+    matches = self._get_matching_outputs(event)
+    outputs = []
+    for output in matches:
+      resolved = {
+          scc.CONF_SETTINGS: self._event_arguments.resolve(
+              event, output.get(scc.CONF_SETTINGS, None), scc.CONF_SETTINGS),
+      }
+      for domain in OUTPUT_DOMAINS:
+        resolved[domain] = [
+            self._event_arguments.resolve(event, entry, domain)
+            for entry in output.get(domain, [])]
+      outputs.append(resolved)
+
+    if key is not None:
+      expiry = conditions.get_next_time_boundary(
+          self._app, current_datetime, self._output_condition_leaves)
+      self._output_cache[key] = (expiry, outputs)
+      if len(self._output_cache) > OUTPUT_CACHE_SIZE:
+        self._output_cache.popitem(last=False)
+    return outputs
 
   def _get_matching_outputs(self, event) -> list:
-    event_tags = event.get(scc.CONF_TAGS)
-    matches = []
-    current_datetime = self._app.datetime()
-    for output in self._config.get(scc.CONF_OUTPUTS):
-      if scc.CONF_CONDITION in output and not conditions.evaluate_condition(
-            self._app, current_datetime, output[scc.CONF_CONDITION],
-            evaluators=self._output_evaluators, event=event):
-        continue
-      matches.append(output)
-    return matches
+    results = conditions.evaluate_many(
+        self._compiled_output_conditions,
+        conditions.StateSnapshot(self._app),
+        event=event)
+    return [output for result, output in zip(
+        results, self._config.get(scc.CONF_OUTPUTS, [])) if result]
 
   def _process_single_event(self, event, outputs):
+    # The Sonos players still in use by the actions of previous events
+    # (before this event's actions are added).
+    sonos_entities_in_flight = self._get_sonos_entities_in_flight()
+
     executable_actions = []
-    self._app.log('>> Creating actions: %s / %s' % (event, outputs))
-    self._app.log('>>> Creating Sonos actions: %s' % event)
+    self._logger.debug('>> Creating actions: %s / %s', event, outputs)
+    self._logger.debug('>>> Creating Sonos actions: %s', event)
     executable_actions.extend(self._create_sonos_actions(event, outputs))
-    self._app.log('>>> Creating Light actions: %s' % event)
+    self._logger.debug('>>> Creating Light actions: %s', event)
     executable_actions.extend(self._create_light_actions(event, outputs))
-    self._app.log('>>> Creating Notify actions: %s' % event)
+    self._logger.debug('>>> Creating Notify actions: %s', event)
     executable_actions.extend(self._create_notify_actions(event, outputs))
-    self._app.log('>>> Creating MQTT actions: %s' % event)
+    self._logger.debug('>>> Creating MQTT actions: %s', event)
     executable_actions.extend(self._create_mqtt_actions(event, outputs))
 
-    self._app.log('>> Finished creating actions: %s' % event)
-    self._app.log('>> Total actions to execute: %i' % len(executable_actions))
+    self._logger.debug('>> Finished creating actions: %s', event)
+    self._logger.info('>> Total actions to execute: %i', len(executable_actions))
 
     execution_groups = {}
-    has_sonos_action = False
+    needs_sonos_snapshot = False
 
     for action in executable_actions:
       execution_groups.setdefault(action.get_priority(), []).append(action)
 
       if self._is_sonos_action(action):
-        has_sonos_action = True
+        needs_sonos_snapshot |= action.needs_snapshot()
 
-    if has_sonos_action and not self._captured_global_sonos_state:
-      # Capture global state, rather than doing it per-entity. As we cannot
-      # read the group status, it's possible to end up with broken
-      # configuration if we snapshot with only some entities (e.g. two
-      # events, with different overlapping entity_ids will result in
-      # capturing an an inappropriate intermediate state).
-      actions.SonosAction.capture_global_sonos_state(self._app)
-      self._captured_global_sonos_state = True
+    if needs_sonos_snapshot and self._captured_sonos_entity_ids is None:
+      self._capture_sonos_state(sonos_entities_in_flight)
 
     for priority_key in sorted(execution_groups, reverse=True):
-      self._app.log('>>> Executing actions with priority: %i' % priority_key)
-      self._create_worker_thread(
-          self._parallel_execute_actions,
-          (execution_groups[priority_key],))
-
-    self._app.log('>> Finished with single event: %s' % event)
-
-  def _create_worker_thread(self, func, args):
-    worker = threading.Thread(
-        target=lambda *args, **kwargs: self._thread_wrap_for_appdaemon(
-            func, *args, **kwargs),
-        args=args)
-    worker.daemon = True
-    worker.start()
-    return worker
-
+      self._logger.debug('>>> Executing actions with priority: %i', priority_key)
+      self._parallel_execute_actions(execution_groups[priority_key])
+
+    self._logger.debug('>> Finished with single event: %s', event)
+
+  def _capture_sonos_state(self, sonos_entities_in_flight):
+    # Capture global state, rather than doing it per-entity. It's possible
+    # to end up with broken configuration if we snapshot with only some
+    # entities (e.g. two events, with different overlapping entity_ids will
+    # result in capturing an an inappropriate intermediate state). The
+    # snapshot (and restore) is skipped if the groups already match and
+    # every player is idle, as there is then nothing to restore.
+    #
+    # Sonos actions still in flight here skipped the snapshot, so their
+    # players were idle and already grouped before they started. Those
+    # players are left out of the snapshot (and so the restore), as it would
+    # otherwise capture the earlier event's playback.
+    entity_ids = 'all'
+    if sonos_entities_in_flight:
+      entity_ids = [
+          entity_id for entity_id in actions.SonosAction.get_sonos_entity_ids(
+              actions.SonosAction.get_players_state(self._app))
+          if entity_id not in sonos_entities_in_flight]
+      if not entity_ids:
+        return
+    actions.SonosAction.capture_global_sonos_state(
+        self._app, self._logger, entity_ids)
+    self._captured_sonos_entity_ids = entity_ids
+
+  @abc.abstractmethod
   def _parallel_execute_actions(self, actions_to_execute):
-    # Start threads to execute the actions at this priority band in parallel.
-    for call in ('prepare', 'action'):
-      workers = []
-      for action in actions_to_execute:
-        workers.append(self._create_worker_thread(
-            lambda action: getattr(action, call)(),
-            (action,)))
+    """Execute the actions of a priority band in parallel, preparing all of
+    them before any action is taken."""
 
-      for worker in workers:
-        worker.join()
+  @abc.abstractmethod
+  def terminate(self):
+    """Stop the controller."""
 
   def _get_entities_involved_in_outputs(self, outputs) -> set:
     entities = set()
     for output in outputs:
       for domain in [scc.CONF_SONOS, scc.CONF_LIGHT]:
-        if domain in output:
-          for entity_set in output[domain]:
-            for entity_id in entity_set.get(scc.CONF_ENTITIES):
-              if (domain == scc.CONF_LIGHT and
-                  entity_id in self._underlying_light_entities):
-                entities = entities.union(set(self._underlying_light_entities[
-                    entity_id]))
-              else:
-                entities.add(entity_id)
+        for entity_set in output[domain]:
+          for entity_id in entity_set.get(scc.CONF_ENTITIES):
+            if (domain == scc.CONF_LIGHT and
+                entity_id in self._underlying_light_entities):
+              entities = entities.union(set(self._underlying_light_entities[
+                  entity_id]))
+            else:
+              entities.add(entity_id)
     return entities
 
   def _get_sonos_primary(self, group_entities):
@@ -310,25 +442,29 @@ class StatusController(threading.Thread):
 
     # Get all the sonos players with the same group key.
     for output in outputs:
-      if scc.CONF_SONOS in output:
-        for sonos in output.get(scc.CONF_SONOS):
-          arguments = scc.get_event_arguments(self._config, event, sonos, scc.CONF_SONOS)
-          filtered_args = self._filter_sonos_args(arguments)
-          tmp = filtered_args.items()
-          group_key = frozenset(filtered_args.items())
+      for arguments in output[scc.CONF_SONOS]:
+        filtered_args = self._filter_sonos_args(arguments)
+        tmp = filtered_args.items()
+        group_key = frozenset(filtered_args.items())
 
-          for entity_id in arguments.get(scc.CONF_ENTITIES):
-            # Only invoke the 1st action that involves this entity in this event.
-            if entity_id in visited_entity_ids:
-              continue
-            visited_entity_ids.append(entity_id)
+        for entity_id in arguments.get(scc.CONF_ENTITIES):
+          # Only invoke the 1st action that involves this entity in this event.
+          if entity_id in visited_entity_ids:
+            continue
+          visited_entity_ids.append(entity_id)
 
-            sonos_groups.setdefault(group_key, []).append((entity_id, arguments))
+          sonos_groups.setdefault(group_key, []).append((entity_id, arguments))
 
     sonos_actions = []
+    if not sonos_groups:
+      return sonos_actions
+
+    # Read the current group topology of all players once for the event.
+    players = actions.SonosAction.get_players_state(self._app)
 
     for group in sonos_groups:
       primary = self._get_sonos_primary(sonos_groups[group])
+      group_actions = []
 
       for entity_id, arguments in sonos_groups[group]:
         action = arguments.get(scc.CONF_ACTION)
@@ -336,9 +472,16 @@ class StatusController(threading.Thread):
         if not action_cls:
           continue
         action_obj = action_cls(self._app, self._report_action_finished,
-                                entity_id, primary, **arguments)
-        self._entity_to_action[entity_id] = action_obj
-        sonos_actions.append(action_obj)
+                                entity_id, primary, log=self._logger,
+                                **arguments)
+        self._add_action(action_obj, [entity_id])
+        group_actions.append(action_obj)
+
+      # The group's primary unjoins/joins/sets volumes for the whole group,
+      # with a service call per step rather than per entity.
+      for action_obj in group_actions:
+        action_obj.set_group(group_actions, players)
+      sonos_actions.extend(group_actions)
 
     return sonos_actions
 
@@ -352,76 +495,223 @@ class StatusController(threading.Thread):
     visited_entity_ids = set()
     light_actions = []
 
+    # Capture the state of every entity (and underlying entity) involved at
+    # once, rather than per entity.
+    entity_ids = set()
     for output in outputs:
-      if scc.CONF_LIGHT in output:
-        for light in output.get(scc.CONF_LIGHT):
-          arguments = scc.get_event_arguments(
-              self._config, event, light, scc.CONF_LIGHT)
-          for entity_id in arguments.pop(scc.CONF_ENTITIES):
-            if entity_id in self._underlying_light_entities:
-              underlying_entity_ids = set(self._underlying_light_entities[entity_id])
-            else:
-              underlying_entity_ids = set([entity_id])
-
-            # Only invoke the 1st action that involves this entity in this event
-            revisited_entity_ids = visited_entity_ids.intersection(
-                underlying_entity_ids)
-            if revisited_entity_ids:
-              self._app.log(
-                  'Entities (%s) feature multiple times for event: %s' % (
-                  revisited_entity_ids, event))
-              continue
-            visited_entity_ids = visited_entity_ids.union(underlying_entity_ids)
-
-            action_cls = actions.LIGHT_ACTION_MAP[arguments.get(scc.CONF_ACTION)]
-            if not action_cls:
-              continue
-
-            for underlying_entity_id in underlying_entity_ids:
-              if underlying_entity_id not in self._captured_light_state:
-                self._captured_light_state[underlying_entity_id] = (
-                    actions.LightActionBase.capture_state(
-                        self._app, underlying_entity_id))
-
-            state_to_register = {}
-            for underlying_entity_id in underlying_entity_ids:
-              state_to_register[underlying_entity_id] = \
-                  self._captured_light_state[underlying_entity_id]
-
-            action = action_cls(
-                self._app, self._report_action_finished,
-                entity_id, state_to_register, **arguments)
-
-            for underlying_entity_id in underlying_entity_ids:
-              self._entity_to_action[underlying_entity_id] = action
-            light_actions.append(action)
+      for light in output[scc.CONF_LIGHT]:
+        for entity_id in light.get(scc.CONF_ENTITIES):
+          entity_ids.add(entity_id)
+          entity_ids.update(self._underlying_light_entities.get(entity_id, []))
+    if not entity_ids:
+      return light_actions
+    states = self._capture_light_states(entity_ids)
+
+    for output in outputs:
+      for light in output[scc.CONF_LIGHT]:
+        arguments = copy.copy(light)
+        for entity_id in arguments.pop(scc.CONF_ENTITIES):
+          if entity_id in self._underlying_light_entities:
+            underlying_entity_ids = set(self._underlying_light_entities[entity_id])
+          else:
+            underlying_entity_ids = set([entity_id])
+
+          # Only invoke the 1st action that involves this entity in this event
+          revisited_entity_ids = visited_entity_ids.intersection(
+              underlying_entity_ids)
+          if revisited_entity_ids:
+            self._logger.info(
+                'Entities (%s) feature multiple times for event: %s',
+                revisited_entity_ids, event)
+            continue
+          visited_entity_ids = visited_entity_ids.union(underlying_entity_ids)
+
+          action_cls = actions.LIGHT_ACTION_MAP[arguments.get(scc.CONF_ACTION)]
+          if not action_cls:
+            continue
+
+          for underlying_entity_id in underlying_entity_ids:
+            if underlying_entity_id not in self._captured_light_state:
+              self._captured_light_state[underlying_entity_id] = (
+                  states[underlying_entity_id])
+
+          state_to_register = {}
+          for underlying_entity_id in underlying_entity_ids:
+            state_to_register[underlying_entity_id] = \
+                self._captured_light_state[underlying_entity_id]
+
+          action_arguments = {}
+          if issubclass(action_cls, actions.BreathingLightAction):
+            action_arguments['scheduler'] = self._breathing_scheduler
+
+          action = action_cls(
+              self._app, self._report_action_finished,
+              entity_id, state_to_register,
+              current_state=(states[entity_id] or {}).get(scc.KEY_STATE),
+              log=self._logger,
+              **action_arguments, **arguments)
+
+          self._add_action(action, underlying_entity_ids)
+          light_actions.append(action)
 
     return light_actions
 
+  def _capture_light_states(self, entity_ids):
+    start = time.monotonic()
+    states = actions.LightActionBase.capture_states(
+        self._app, entity_ids, self._logger)
+    self._logger.debug('Captured state of %i entities in %.1f ms',
+                       len(entity_ids), (time.monotonic() - start) * 1000)
+    return states
+
   def _create_notify_actions(self, event, outputs):
     notify_actions = []
     for output in outputs:
-      if scc.CONF_NOTIFY in output:
-        for notify in output.get(scc.CONF_NOTIFY):
-          arguments = scc.get_event_arguments(
-              self._config, event, notify, scc.CONF_NOTIFY)
-          notify_actions.append(actions.NotifyAction(
-              self._app, self._report_action_finished, **arguments))
+      for arguments in output[scc.CONF_NOTIFY]:
+        notify_actions.append(actions.NotifyAction(
+            self._app, self._report_action_finished, log=self._logger,
+            **arguments))
     return notify_actions
 
   def _create_mqtt_actions(self, event, outputs):
     mqtt_actions = []
     for output in outputs:
-      if scc.CONF_MQTT in output:
-        for mqtt in output.get(scc.CONF_MQTT):
-          arguments = scc.get_event_arguments(
-              self._config, event, mqtt, scc.CONF_MQTT)
-
-          # Process the payload through jinja2.
-          if scc.CONF_ACTION_MQTT_PAYLOAD in arguments:
-            template = jinja2.Template(arguments[scc.CONF_ACTION_MQTT_PAYLOAD])
-            arguments[scc.CONF_ACTION_MQTT_PAYLOAD] = template.render(
-                tags=event[scc.CONF_TAGS])
-          mqtt_actions.append(actions.MQTTAction(
-              self._app, self._report_action_finished, **arguments))
+      for mqtt in output[scc.CONF_MQTT]:
+        arguments = copy.copy(mqtt)
+
+        # Process the payload through jinja2.
+        if scc.CONF_ACTION_MQTT_PAYLOAD in arguments:
+          arguments[scc.CONF_ACTION_MQTT_PAYLOAD] = templates.render(
+              arguments[scc.CONF_ACTION_MQTT_PAYLOAD],
+              tags=event[scc.CONF_TAGS])
+        mqtt_actions.append(actions.MQTTAction(
+            self._app, self._report_action_finished, log=self._logger,
+            **arguments))
     return mqtt_actions
+
+
+class StatusController(StatusControllerBase, threading.Thread):
+  """Runs the controller cycle in its own thread, executing actions on a
+  bounded worker pool."""
+  def __init__(self, app, config, *args, **kwargs):
+    StatusControllerBase.__init__(self, app, config)
+    threading.Thread.__init__(self, *args, **kwargs)
+    self._workers = workers.WorkerPool(
+        config.get(scc.CONF_WORKERS), name='status-controller')
+    self._terminated = False
+
+  def run(self):
+    self._thread_wrap_for_appdaemon(self._run_controller_cycle)
+
+  def terminate(self):
+    """Stop the controller thread and the worker pool (e.g. when the app is
+    terminated or reloaded)."""
+    with self._cv:
+      self._terminated = True
+      self._cv.notify()
+    self._workers.shutdown()
+
+  def _run_controller_cycle(self):
+    with self._cv:
+      while not self._terminated:
+        self._logger.debug('Starting controller cycle, waiting...')
+        self._cv.wait()
+        if self._terminated:
+          break
+        self._logger.debug('...controller woken')
+        self._run_cycle()
+
+  def add(self, event):
+    event_tpl = self._get_event_tuple(event)
+    if event_tpl:
+      with self._cv:
+        heapq.heappush(self._events, event_tpl)
+        self._cv.notify()
+
+  def _report_action_finished(self, action):
+    with self._cv:
+      self._finished_actions.add(action)
+      self._cv.notify()
+
+  def _parallel_execute_actions(self, actions_to_execute):
+    self._workers.submit_phases([
+        [functools.partial(
+            self._thread_wrap_for_appdaemon, getattr(action, call))
+         for action in actions_to_execute]
+        for call in ('prepare', 'action')])
+    if self._logger.is_enabled_for(logger.LEVEL_DEBUG):
+      self._logger.debug('>> Worker pool: %s', self._workers.get_metrics())
+
+
+class AsyncStatusController(StatusControllerBase):
+  """Runs the controller cycle as a task on the AppDaemon event loop.
+
+  New events and finished actions are passed to the task on an asyncio.Queue.
+  The cycle itself makes blocking AppDaemon calls (e.g. capturing light
+  state), so it is run on the AppDaemon executor. Actions are executed on the
+  event loop, with the prepare and action phases of each priority band
+  gathered in turn."""
+  def __init__(self, app, config):
+    super().__init__(app, config)
+    self._loop = None
+    self._inbox = None
+    self._task = None
+
+  async def run(self):
+    with self._cv:
+      self._loop = asyncio.get_running_loop()
+      self._inbox = asyncio.Queue()
+      self._task = asyncio.current_task()
+
+    while True:
+      # The first cycle processes any events added before the loop started.
+      await self._app.run_in_executor(
+          self._thread_wrap_for_appdaemon, self._run_cycle)
+
+      self._logger.debug('Starting controller cycle, waiting...')
+      self._receive(await self._inbox.get())
+      while not self._inbox.empty():
+        self._receive(self._inbox.get_nowait())
+      self._logger.debug('...controller woken')
+
+  def terminate(self):
+    with self._cv:
+      if self._task is not None:
+        self._loop.call_soon_threadsafe(self._task.cancel)
+
+  def _receive(self, item):
+    if isinstance(item, tuple):
+      heapq.heappush(self._events, item)
+    else:
+      self._finished_actions.add(item)
+
+  def add(self, event):
+    event_tpl = self._get_event_tuple(event)
+    if not event_tpl:
+      return
+    with self._cv:
+      if self._loop is None:
+        heapq.heappush(self._events, event_tpl)
+        return
+    self._loop.call_soon_threadsafe(self._inbox.put_nowait, event_tpl)
+
+  def _report_action_finished(self, action):
+    # May be called from the event loop, or any AppDaemon thread.
+    self._loop.call_soon_threadsafe(self._inbox.put_nowait, action)
+
+  def _parallel_execute_actions(self, actions_to_execute):
+    # Called from the cycle, on the executor.
+    asyncio.run_coroutine_threadsafe(
+        self._execute_actions(actions_to_execute), self._loop)
+
+  async def _execute_actions(self, actions_to_execute):
+    for call in ('async_prepare', 'async_action'):
+      results = await asyncio.gather(
+          *[getattr(action, call)() for action in actions_to_execute],
+          return_exceptions=True)
+      for result in results:
+        if isinstance(result, Exception):
+          stack_trace = ''.join(traceback.format_exception(
+              type(result), result, result.__traceback__))
+          self._app.error('%s%s%s' % (result, os.linesep, stack_trace),
+                          level="ERROR")
@@ -0,0 +1,44 @@
+import functools
+
+import jinja2
+
+import config as scc
+
+# Compiled jinja2 templates (e.g. MQTT payloads), cached by source.
+#
+# Compiling a template is far more expensive than rendering it, and the set of
+# distinct template sources is small (those in the configuration, plus any
+# sent with events), so each is compiled once and shared. The templates in the
+# configuration are compiled at startup by warm_from_config().
+
+TEMPLATE_CACHE_SIZE = 128
+
+# As used by jinja2.Template(source).
+_ENVIRONMENT = jinja2.Environment()
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def get_template(source):
+  return _ENVIRONMENT.from_string(source)
+
+def render(source, **kwargs):
+  return get_template(source).render(**kwargs)
+
+def get_config_template_sources(config):
+  """Return the MQTT payload templates that may be rendered for the
+  configuration: the default, and those of the tags and outputs."""
+  sources = {scc.DEFAULTS_MAPPING[scc.CONF_MQTT][scc.CONF_ACTION_MQTT_PAYLOAD]}
+  tags = config.get(scc.CONF_TAGS) or {}
+  for tag in tags:
+    payload = (tags[tag] or {}).get(scc.CONF_MQTT, {}).get(
+        scc.CONF_ACTION_MQTT_PAYLOAD)
+    if payload is not None:
+      sources.add(payload)
+  for output in config.get(scc.CONF_OUTPUTS, []):
+    for mqtt in output.get(scc.CONF_MQTT, []):
+      if scc.CONF_ACTION_MQTT_PAYLOAD in mqtt:
+        sources.add(mqtt[scc.CONF_ACTION_MQTT_PAYLOAD])
+  return sources
+
+def warm_from_config(config):
+  for source in get_config_template_sources(config):
+    get_template(source)
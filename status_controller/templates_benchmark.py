@@ -0,0 +1,65 @@
+"""Benchmark harness for templates.py.
+
+Renders MQTT payload templates for generated tag lists, reporting ops/sec and
+tracemalloc allocations for each rendering path:
+
+  - cold: compiles the template on every render (jinja2.Template(source), the
+    previous implementation).
+  - warm: renders the cached compiled template (templates.render()).
+
+No AppDaemon is required. Run directly, e.g.:
+
+  python templates_benchmark.py --tags 5 --number 2000
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import jinja2
+
+if __name__ == '__main__':
+  # Both config.py (via conditions.py) and the timing and allocation helpers
+  # of conditions_benchmark.py need common/ on the path.
+  sys.path.insert(0, os.path.join(
+      os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+
+import conditions_benchmark
+import config as scc
+import templates
+
+PAYLOADS = [
+    scc.DEFAULT_MQTT_PAYLOAD,
+    '{"tags": {{ tags|tojson }}, "count": {{ tags|length }}}',
+    '{% for tag in tags %}{{ tag|upper }}{% if not loop.last %},'
+    '{% endif %}{% endfor %}',
+]
+
+
+def main(tags=5, number=2000):
+  event_tags = ['tag_%i' % i for i in range(tags)]
+  templates.warm_from_config({
+      scc.CONF_OUTPUTS: [{scc.CONF_MQTT: [
+          {scc.CONF_ACTION_MQTT_PAYLOAD: payload} for payload in PAYLOADS]}],
+  })
+
+  print('tags=%i number=%i' % (tags, number))
+  for payload in PAYLOADS:
+    cold = lambda: jinja2.Template(payload).render(tags=event_tags)
+    warm = lambda: templates.render(payload, tags=event_tags)
+    assert cold() == warm()
+
+    print('payload %s' % json.dumps(payload))
+    cold_secs = conditions_benchmark.run_benchmark('cold', cold, number)
+    warm_secs = conditions_benchmark.run_benchmark('warm', warm, number)
+    print('  warm speedup over cold: %.2fx' % (cold_secs / warm_secs))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--tags', type=int, default=5)
+  parser.add_argument('--number', type=int, default=2000)
+  args = parser.parse_args()
+
+  main(tags=args.tags, number=args.number)
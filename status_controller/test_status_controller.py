@@ -0,0 +1,178 @@
+"""Tests for status-controller.py.
+
+The controller cycle is run against a fake app, with hassapi replaced by a
+stand-in if AppDaemon is not installed. Actions are recorded rather than
+executed. Run directly, e.g.:
+
+  python test_status_controller.py
+"""
+
+import datetime
+import importlib.util
+import os
+import sys
+import types
+import unittest
+
+HASSAPI_MODULE = 'appdaemon.plugins.hass.hassapi'
+
+sc = None
+scc = None
+actions = None
+
+
+def setUpModule():
+  global sc, scc, actions
+  # config.py imports conditions.py from common/, which AppDaemon would have
+  # put on the path.
+  here = os.path.dirname(os.path.abspath(__file__))
+  sys.path.insert(0, os.path.join(here, os.pardir, 'common'))
+  sys.path.insert(0, here)
+
+  try:
+    importlib.import_module(HASSAPI_MODULE)
+  except ImportError:
+    module = types.ModuleType(HASSAPI_MODULE)
+    module.Hass = object
+    for name in ('appdaemon', 'appdaemon.plugins', 'appdaemon.plugins.hass'):
+      sys.modules.setdefault(name, types.ModuleType(name))
+    sys.modules[HASSAPI_MODULE] = module
+
+  spec = importlib.util.spec_from_file_location(
+      'status_controller', os.path.join(here, 'status-controller.py'))
+  sc = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(sc)
+  scc = importlib.import_module('config')
+  actions = importlib.import_module('actions')
+
+
+class FakeApp(object):
+  """The AppDaemon API used by the controller, recording service calls."""
+  def __init__(self, players):
+    self.players = players
+    self.service_calls = []
+
+  def datetime(self):
+    return datetime.datetime(2020, 1, 6, 12)
+
+  def log(self, message, level='INFO'):
+    pass
+
+  def get_state(self, entity_id=None, attribute=None):
+    if entity_id == actions.SONOS_DOMAIN:
+      return self.players
+    return None
+
+  def call_service(self, service, **kwargs):
+    self.service_calls.append((service, kwargs.get('entity_id')))
+
+  def get_service_calls(self, service):
+    return [entity_id for called, entity_id in self.service_calls
+            if called == service]
+
+
+def make_controller_class():
+  class RecordingController(sc.StatusControllerBase):
+    """Runs each cycle on demand, recording (not executing) the actions."""
+    def __init__(self, app, config):
+      super().__init__(app, config)
+      self.executed_actions = []
+
+    def add(self, event):
+      event_tpl = self._get_event_tuple(event)
+      if event_tpl:
+        self._events.append(event_tpl)
+      self._run_cycle()
+
+    def finish(self, action):
+      action.complete_action()
+      self._run_cycle()
+
+    def _report_action_finished(self, action):
+      self._finished_actions.add(action)
+
+    def _parallel_execute_actions(self, actions_to_execute):
+      self.executed_actions.extend(actions_to_execute)
+
+    def terminate(self):
+      pass
+
+  return RecordingController
+
+
+def make_player(entity_id, state):
+  return {
+    'entity_id': entity_id,
+    'state': state,
+    'attributes': {actions.SONOS_ATTR_GROUP: [entity_id]},
+  }
+
+
+class SonosSnapshotTest(unittest.TestCase):
+  CONFIG = {
+    'event_name': 'status',
+    'outputs': [
+      {'condition': [{'tag': 'kitchen'}],
+       'sonos': [{'entities': ['media_player.kitchen'], 'message': 'a'}]},
+      {'condition': [{'tag': 'lounge'}],
+       'sonos': [{'entities': ['media_player.lounge'], 'message': 'b'}]},
+    ],
+  }
+
+  def setUp(self):
+    self.app = FakeApp({
+      entity_id: make_player(entity_id, state)
+      for entity_id, state in (
+          ('media_player.kitchen', 'idle'),
+          ('media_player.lounge', 'paused'),
+          ('media_player.office', 'playing'),
+      )})
+    self.controller = make_controller_class()(
+        self.app, scc.CONFIG_SCHEMA(self.CONFIG))
+
+  def add_event(self, tag):
+    self.controller.add(scc.EVENT_SCHEMA({'tags': [tag]}))
+    return self.controller.executed_actions[-1]
+
+  def test_idle_players_are_not_snapshot(self):
+    action = self.add_event('kitchen')
+    self.controller.finish(action)
+
+    self.assertEqual(
+        self.app.get_service_calls(actions.SONOS_SERVICE_SNAPSHOT), [])
+    self.assertEqual(
+        self.app.get_service_calls(actions.SONOS_SERVICE_RESTORE), [])
+
+  def test_overlapping_event_excludes_players_in_flight(self):
+    # The first event skips the snapshot, as its player is idle. The second
+    # arrives while the first is still playing, so must not snapshot (or
+    # restore) the first event's player.
+    first = self.add_event('kitchen')
+    self.app.players['media_player.kitchen']['state'] = 'playing'
+    second = self.add_event('lounge')
+
+    expected = ['media_player.lounge', 'media_player.office']
+    self.assertEqual(
+        self.app.get_service_calls(actions.SONOS_SERVICE_SNAPSHOT),
+        [expected])
+
+    self.controller.finish(first)
+    self.assertEqual(
+        self.app.get_service_calls(actions.SONOS_SERVICE_RESTORE), [])
+    self.controller.finish(second)
+    self.assertEqual(
+        self.app.get_service_calls(actions.SONOS_SERVICE_RESTORE),
+        [expected])
+
+  def test_event_needing_snapshot_captures_all(self):
+    action = self.add_event('lounge')
+    self.controller.finish(action)
+
+    self.assertEqual(
+        self.app.get_service_calls(actions.SONOS_SERVICE_SNAPSHOT), ['all'])
+    self.assertEqual(
+        self.app.get_service_calls(actions.SONOS_SERVICE_RESTORE), ['all'])
+
+
+if __name__ == '__main__':
+  unittest.main()
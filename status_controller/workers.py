@@ -0,0 +1,101 @@
+import concurrent.futures
+import threading
+import time
+
+# A bounded pool of worker threads on which actions are executed.
+#
+# Actions are executed in phases (e.g. all 'prepare' calls for a priority
+# band, then all 'action' calls). Rather than a thread blocking on the
+# completion of a phase (which could deadlock a bounded pool, with every
+# worker waiting on tasks that cannot be scheduled), the next phase is
+# submitted from the completion callback of the last task in the previous
+# phase.
+
+class WorkerPool(object):
+  def __init__(self, max_workers, name='worker'):
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix=name)
+    self._max_workers = max_workers
+
+    self._lock = threading.Lock()
+    self._queued = 0
+    self._running = 0
+    self._completed = 0
+    self._max_queued = 0
+    self._total_wait_seconds = 0.0
+    self._max_wait_seconds = 0.0
+    self._total_run_seconds = 0.0
+
+  def submit(self, func, *args, **kwargs):
+    """Run func on the pool, returning a concurrent.futures.Future."""
+    submitted = time.monotonic()
+    with self._lock:
+      self._queued += 1
+      self._max_queued = max(self._max_queued, self._queued)
+
+    def run():
+      started = time.monotonic()
+      with self._lock:
+        self._queued -= 1
+        self._running += 1
+        self._total_wait_seconds += started - submitted
+        self._max_wait_seconds = max(
+            self._max_wait_seconds, started - submitted)
+      try:
+        return func(*args, **kwargs)
+      finally:
+        with self._lock:
+          self._running -= 1
+          self._completed += 1
+          self._total_run_seconds += time.monotonic() - started
+    return self._executor.submit(run)
+
+  def submit_phases(self, phases):
+    """Run a list of phases, each a list of callables.
+
+    The callables within a phase run in parallel, and a phase is only started
+    once every callable in the previous phase has completed. Returns a
+    concurrent.futures.Future that is done once the last phase completes."""
+    done = concurrent.futures.Future()
+
+    def start_phase(index):
+      if index == len(phases):
+        done.set_result(None)
+        return
+      if not phases[index]:
+        start_phase(index + 1)
+        return
+
+      remaining = [len(phases[index])]
+      def task_done(future):
+        with self._lock:
+          remaining[0] -= 1
+          phase_done = remaining[0] == 0
+        if phase_done:
+          start_phase(index + 1)
+
+      for func in phases[index]:
+        self.submit(func).add_done_callback(task_done)
+
+    start_phase(0)
+    return done
+
+  def get_metrics(self):
+    with self._lock:
+      started = self._completed + self._running
+      return {
+        'max_workers': self._max_workers,
+        'queued': self._queued,
+        'max_queued': self._max_queued,
+        'running': self._running,
+        'completed': self._completed,
+        'mean_wait_seconds': (
+            self._total_wait_seconds / started if started else 0.0),
+        'max_wait_seconds': self._max_wait_seconds,
+        'mean_run_seconds': (
+            self._total_run_seconds / self._completed
+            if self._completed else 0.0),
+      }
+
+  def shutdown(self, wait=False):
+    self._executor.shutdown(wait=wait)